@@ -3,20 +3,111 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
-import os
-import ctypes
 import time
 
+from .CommsCapabilities import call_optional_comms_method
+from .FirmwareImage import FirmwareImage
+from .Poller import Poller, precise_sleep
+
+
 class Bootloader:
     # Bootloader protocol registers
     BLP_FIFO_ADDRESS = 0x0102
     BLP_REG_COMMAND = 0x0100
     BLP_REG_STATUS = 0x0100
 
+    # Largest write the bootloader FIFO accepts, PAGE_SIZE - 1
+    BLP_MAX_FIFO_WRITE_LENGTH = 255
+
+    # Bounds for the sleep between busy polls, in seconds, and the busy time below which
+    # polling back to back beats sleeping
+    BUSY_MIN_DELAY = 0.0001
+    BUSY_MAX_DELAY = 0.001
+    BUSY_SPIN_THRESHOLD = 0.0002
+    BUSY_TIME_SMOOTHING = 0.1
+
     def __init__(self, axiom=None, comms=None):
         self._axiom = axiom
         self._comms = comms
 
+        # Waits for the bootloader's busy flag to clear, retuned from the busy times seen
+        self.busy_poller = Poller(self._axiom.TIMEOUT_MS / 1000 if self._axiom is not None else 5.0,
+                                  spin_polls=1, initial_delay=self.BUSY_MAX_DELAY, max_delay=self.BUSY_MAX_DELAY,
+                                  backoff=1.0, sleep=precise_sleep)
+        self.typical_busy_time = None
+
+        # Time, in seconds, the bootloader was busy while each chunk was written
+        self.chunk_busy_times = []
+
+    def flash(self, path_or_fileobj, progress_callback=None):
+        """
+        Loads a firmware image onto aXiom: enters the bootloader, writes the image's chunks, resets
+        aXiom and checks it comes back running the firmware in the image.
+
+        Parameters:
+        path_or_fileobj: Path to an .axfw or .alc file, a binary file object or a FirmwareImage.
+        progress_callback: Optional, called after each chunk as
+                           progress_callback(bytes_written, total_bytes, bytes_per_second, eta_seconds).
+
+        Returns the average bytes per second written to the bootloader.
+
+        Raises:
+        Exception: If aXiom does not enter the bootloader, or does not come back running the new firmware.
+        """
+        if isinstance(path_or_fileobj, FirmwareImage):
+            image = path_or_fileobj
+        else:
+            image = FirmwareImage(path_or_fileobj)
+
+        try:
+            if not self.enter_bootloader_mode():
+                print("ERROR: Failed to enter bootloader mode")
+                raise Exception("Failed to enter bootloader mode")
+
+            bytes_per_second = self._write_image(image, progress_callback)
+
+            self.reset_axiom()
+            self._check_flashed_firmware(image)
+        finally:
+            if image is not path_or_fileobj:
+                image.close()
+
+        return bytes_per_second
+
+    def _write_image(self, image, progress_callback):
+        total_bytes = image.size
+        bytes_written = 0
+        start = time.perf_counter()
+
+        for chunk in image.chunks():
+            self.write_chunk(chunk)
+            bytes_written += len(chunk)
+
+            if progress_callback is not None:
+                elapsed = time.perf_counter() - start
+                bytes_per_second = (bytes_written / elapsed) if elapsed > 0 else 0.0
+                eta = ((total_bytes - bytes_written) / bytes_per_second) if bytes_per_second > 0 else 0.0
+                progress_callback(bytes_written, total_bytes, bytes_per_second, eta)
+
+        elapsed = time.perf_counter() - start
+        return (bytes_written / elapsed) if elapsed > 0 else 0.0
+
+    def _check_flashed_firmware(self, image):
+        # aXiom should be running the new firmware, the usage table is rebuilt for it
+        u31 = self._axiom.u31
+        if not u31.build_usage_table():
+            print("ERROR: aXiom is still in bootloader mode after loading firmware")
+            raise Exception("aXiom is still in bootloader mode after loading firmware")
+
+        # ALC files do not say which firmware they contain
+        if image.is_axfw and ((u31.reg_fw_major, u31.reg_fw_minor, u31.reg_fw_variant) !=
+                              (image.fw_major, image.fw_minor, image.fw_variant)):
+            message = "aXiom is running firmware %d.%d variant %d, the image is %d.%d variant %d" % (
+                u31.reg_fw_major, u31.reg_fw_minor, u31.reg_fw_variant,
+                image.fw_major, image.fw_minor, image.fw_variant)
+            print("ERROR: " + message)
+            raise Exception(message)
+
     def enter_bootloader_mode(self):
         attempts = 5
 
@@ -57,40 +148,66 @@ class Bootloader:
         return (status[2] & 0x01) != 0
 
     def _precise_sleep(self, duration_seconds):
-        if os.name == 'nt':  # Windows
-            ctypes.windll.winmm.timeBeginPeriod(1)
-            time.sleep(duration_seconds)
-            ctypes.windll.winmm.timeEndPeriod(1)
-        elif os.name == 'posix':  # Linux/Unix
-            ctypes.CDLL('libc.so.6').usleep(int(duration_seconds * 1_000_000))  # Convert seconds to microseconds
-        else:
-            # An alternative approach to sleep for a precise duration
-            # This approach can be CPU intensive.
-            start = time.perf_counter()
-            while (time.perf_counter() - start) < duration_seconds:
-                pass
+        precise_sleep(duration_seconds)
 
     def _wait_until_not_busy(self):
-        current_timeout = 0
-        while self._get_busy_status():
-            # aXiom is busy, wait 1ms before trying again
-            if current_timeout < self._axiom.TIMEOUT_MS:
-                current_timeout = current_timeout + 1
-            else:
-                print("ERROR: aXiom does not seem to be responding...")
-                raise TimeoutError
+        # Poll the busy flag until it clears or the deadline passes, a wall clock timeout
+        # regardless of how long each status read takes on the bus.
+        try:
+            self.busy_poller.poll(self._is_not_busy, self._axiom.TIMEOUT_MS / 1000)
+        except TimeoutError:
+            print("ERROR: aXiom does not seem to be responding...")
+            raise
+
+        self._tune_busy_poller(self.busy_poller.wait_time)
+        return self.busy_poller.wait_time
+
+    def _is_not_busy(self):
+        return None if self._get_busy_status() else True
+
+    def _tune_busy_poller(self, busy_time):
+        # Track how long the bootloader is typically busy. Short busy periods are caught by polling
+        # straight away, otherwise the first sleep is half the typical busy time so the flag is
+        # checked again around when it is expected to clear.
+        if self.typical_busy_time is None:
+            self.typical_busy_time = busy_time
+        else:
+            self.typical_busy_time += (busy_time - self.typical_busy_time) * self.BUSY_TIME_SMOOTHING
 
-            # If busy, allow the bootloader to run a bit longer before asking again.
-            # A time.sleep(0.001) is not precise enough, it takes more than 1ms.
-            self._precise_sleep(0.001)
+        if self.typical_busy_time < self.BUSY_SPIN_THRESHOLD:
+            self.busy_poller.spin_polls = 4
+        else:
+            self.busy_poller.spin_polls = 1
+        self.busy_poller.initial_delay = min(max(self.typical_busy_time / 2, self.BUSY_MIN_DELAY), self.BUSY_MAX_DELAY)
 
     def reset_axiom(self):
-        self._comms.write_page(self.BLP_REG_COMMAND, 2, [0x02, 0x00])
+        if self._axiom is not None:
+            self._axiom.invalidate_caches()
+
+        try:
+            self._comms.write_page(self.BLP_REG_COMMAND, 2, [0x02, 0x00])
+            call_optional_comms_method(self._comms, "flush_write_acks")
+        except IOError:
+            pass  # aXiom resets as soon as it accepts the command, the write may not be acknowledged
         time.sleep(0.150)
 
     def write_chunk(self, chunk):
-        offset = 0
-        length = len(chunk)
+        chunk_size = self._chunk_payload_size()
+
+        # Write acknowledgements, where the comms interface defers them, are collected
+        # alongside the busy status reads rather than after every write.
+        call_optional_comms_method(self._comms, "begin_write_batch")
+        try:
+            self._write_chunk_payloads(chunk, chunk_size)
+        finally:
+            call_optional_comms_method(self._comms, "end_write_batch")
+
+    def _chunk_payload_size(self):
+        # Each write to the FIFO has to reach aXiom as a single bus transaction, comms interfaces
+        # describe how much that can carry. The FIFO itself limits the write size as well.
+        capabilities = getattr(self._comms, "capabilities", None)
+        if capabilities is not None:
+            return min(capabilities.max_transfer_length, self.BLP_MAX_FIFO_WRITE_LENGTH)
 
         # The following slicing depends on the type of communication link.
         # here we probe the comms class to see if we have any USB specific
@@ -106,6 +223,13 @@ class Bootloader:
         except AttributeError:
             chunk_size = self._axiom.u31.PAGE_SIZE - 1
 
+        return chunk_size
+
+    def _write_chunk_payloads(self, chunk, chunk_size):
+        offset = 0
+        length = len(chunk)
+        busy_time = 0.0
+
         while offset < length:
             # Calculate how much data to transfer, up to the max transfer size
             if (offset + chunk_size) < length:
@@ -117,7 +241,7 @@ class Bootloader:
             payload_chunk = chunk[offset:(offset + length_to_write)]
 
              # Ensure aXiom is available to process our request
-            self._wait_until_not_busy()
+            busy_time += self._wait_until_not_busy()
 
             # Send the data to aXiom
             self._comms.write_page(self.BLP_FIFO_ADDRESS, length_to_write, payload_chunk)
@@ -125,4 +249,5 @@ class Bootloader:
             offset += length_to_write
 
         # Wait for the last page write to complete
-        self._wait_until_not_busy()
+        busy_time += self._wait_until_not_busy()
+        self.chunk_busy_times.append(busy_time)
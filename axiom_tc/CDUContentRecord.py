@@ -0,0 +1,49 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+import hashlib
+
+from .JsonFileStore import JsonFileStore
+
+
+class CDUContentRecord:
+    """
+    Records the u33 CRC a device reported after a CDU was committed with a given content. The content
+    is identified by its SHA-256, so the content itself is never stored. If the CRC recorded for the
+    content about to be written matches the CRC the device reports now, the device already holds
+    that content and the store/commit can be skipped.
+
+    The record is kept in memory, and optionally in a JSON file so it persists across sessions.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path=None):
+        self._store = JsonFileStore(path, self.FORMAT_VERSION) if path is not None else None
+        self._entries = None
+
+    def lookup(self, device_id, usage, content):
+        """
+        Returns the u33 CRC recorded for the content of the given CDU, or None.
+        """
+        return self._load().get(self._key(device_id, usage, content))
+
+    def store(self, device_id, usage, content, crc):
+        entries = self._load()
+        entries[self._key(device_id, usage, content)] = crc
+        if self._store is not None:
+            self._store.save(entries)
+
+    def clear(self):
+        self._entries = {}
+        if self._store is not None:
+            self._store.remove()
+
+    def _key(self, device_id, usage, content):
+        return "%04X-u%02X-%s" % (device_id, usage, hashlib.sha256(bytes(content)).hexdigest())
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._store.load() if self._store is not None else {}
+        return self._entries
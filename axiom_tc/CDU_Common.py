@@ -3,7 +3,23 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
-from time import sleep
+from .Poller import Poller
+
+
+class CDU_Error(Exception):
+    """
+    Raised when a CDU command fails or does not complete in time. status is the CDU status word
+    reported by aXiom, or None if the command timed out.
+    """
+    def __init__(self, usage, operation, status):
+        if status is None:
+            message = "CDU %s timed out. u%02X" % (operation, usage)
+        else:
+            message = "CDU %s failure. u%02X Status: 0x%04X" % (operation, usage, status)
+        super().__init__(message)
+        self.usage = usage
+        self.operation = operation
+        self.status = status
 
 
 class CDU_Common:
@@ -12,168 +28,216 @@ class CDU_Common:
     CDU_CMD_COMMIT = 0x0003
     CDU_CMD_QUERY = 0x0004
 
+    CDU_HEADER_SIZE = 8
     CDU_XFER_SIZE = 48
     CDU_ERROR_MASK = 0x8000
 
+    # Time allowed for a commit to write the CDU to flash, in seconds
+    COMMIT_TIMEOUT = 5.0
+
     def __init__(self, axiom):
         self.__axiom = axiom
 
-    def read(self, usage):
-        length = self.__cdu_query(usage)
+        # One poller per CDU operation, each bounded by the axiom comms timeout. Their poll
+        # counts and wait times show where the time goes.
+        timeout = axiom.TIMEOUT_MS / 1000
+        self.pollers = {
+            "query": Poller(timeout, spin_polls=4),
+            "fetch": Poller(timeout, spin_polls=4),
+            "store": Poller(timeout, spin_polls=4),
+            # The flash write takes tens to hundreds of milliseconds, so the commit poll starts slower
+            "commit": Poller(self.COMMIT_TIMEOUT, spin_polls=0, initial_delay=0.005, max_delay=0.05),
+        }
 
-        return self.__cdu_fetch(usage, length)
+        # Time taken by each commit, in seconds, listed per usage
+        self.commit_durations = {}
 
-    def write(self, usage, buffer):
-        self.__cdu_store(usage, buffer)
-        self.__cdu_commit(usage)
+        # Query results, (param0, param1, param2), per usage. They only change when a CDU is
+        # committed or the device is reset, see invalidate_geometry()
+        self._geometry = {}
 
-    def __cdu_query(self, usage):
-        cdu_buffer = [0x00] * self.__axiom.get_usage_length(usage)
-
-        command = CDU_Common.CDU_CMD_QUERY
-
-        # Set the command into the buffer
-        cdu_buffer[0] = (command & 0x00FF)
-        cdu_buffer[1] = (command & 0xFF00) >> 8
-
-        self.__axiom.write_usage(usage, cdu_buffer)
-
-        while True:
-            cdu_buffer = self.__axiom.read_usage(usage)
-            status = cdu_buffer[0] | (cdu_buffer[1] << 8)
-
-            # Check to see if the CDU command completed successfully.
-            if status == 0:
-                # Query completed OK
-                param0 = cdu_buffer[2] | (cdu_buffer[3] << 8)
-                param1 = cdu_buffer[4] | (cdu_buffer[5] << 8)
-                param2 = cdu_buffer[6] | (cdu_buffer[7] << 8)
-
-                # Length in bytes is param0 * param1, param 2 is not used
-                # Unfortunately, u93 is still a special case - this should be
-                # addressed in the future
-                if usage != 0x93:
-                    cdu_usage_length = param0 * param1
-                else:
-                    cdu_usage_length = param1 * param2
-                break
-
-        return cdu_usage_length
-
-    def __cdu_fetch(self, usage, length):
-        cdu_buffer = [0x00] * self.__axiom.get_usage_length(usage)
-        result_buffer = []
+    def read(self, usage):
+        return list(b"".join(self.iter_fetch(usage)))
 
-        command = CDU_Common.CDU_CMD_FETCH
+    def write(self, usage, buffer):
+        self.store_from(usage, buffer)
+        self.commit(usage)
+
+    def iter_fetch(self, usage):
+        """
+        Fetches a CDU's content, yielding it as bytes objects of up to CDU_XFER_SIZE bytes as each
+        chunk arrives from aXiom. The CDU is only queried once iteration starts.
+        """
+        length = self.get_length(usage)
         offset = 0
 
         while offset < length:
-            # Set the command in the buffer
-            cdu_buffer[0] = (command & 0x00FF)
-            cdu_buffer[1] = (command & 0xFF00) >> 8
-
-            # Set the offset into the buffer
-            cdu_buffer[4] = (offset & 0x00FF)
-            cdu_buffer[5] = (offset & 0xFF00) >> 8
+            # Send the command and offset to aXiom to process
+            self.__cdu_command(usage, CDU_Common.CDU_CMD_FETCH, param1=offset)
 
-            # Send the command to aXiom to process
-            self.__axiom.write_usage(usage, cdu_buffer)
-
-            while True:
-                cdu_buffer = self.__axiom.read_usage(usage)
-                status = cdu_buffer[0] | (cdu_buffer[1] << 8)
-
-                if status == 0:
-                    data = cdu_buffer[8:]
-
-                    if (offset + CDU_Common.CDU_XFER_SIZE) < length:
-                        result_buffer += data
-                    else:
-                        result_buffer += data[:(length - offset)]
-
-                    break
-                elif (status & CDU_Common.CDU_ERROR_MASK) != 0:
-                    print("ERROR: CDU Fetch Failure! Status: " + hex(status))
-                else:
-                    # aXiom is still processing the request
-                    pass
+            cdu_buffer = self.__cdu_wait(usage, "fetch", CDU_Common.CDU_HEADER_SIZE + CDU_Common.CDU_XFER_SIZE)
+            chunk_length = min(CDU_Common.CDU_XFER_SIZE, length - offset)
+            yield bytes(cdu_buffer[CDU_Common.CDU_HEADER_SIZE:CDU_Common.CDU_HEADER_SIZE + chunk_length])
 
             # Update the offset
             offset += CDU_Common.CDU_XFER_SIZE
 
-        # Return the CDU's raw data
-        return result_buffer
+    def store_from(self, usage, source):
+        """
+        Stores content into a CDU's staging area without committing it, see commit().
 
-    def __cdu_store(self, usage, buffer):
-        cdu_buffer = [0x00] * self.__axiom.get_usage_length(usage)
+        Parameters:
+        usage: The CDU to store to.
+        source: A bytes-like object or list of byte values, a binary file object, or an iterable of
+                byte values or bytes-like chunks of any size. Files and iterables are consumed lazily.
 
-        command = CDU_Common.CDU_CMD_STORE
+        Returns the number of bytes stored.
+        """
         offset = 0
+        stored = 0
+        for chunk in self.__iter_chunks(source):
+            # If the chunk to write is less than CDU_XFER_SIZE bytes, pad it out with 0s
+            payload = bytes(chunk).ljust(CDU_Common.CDU_XFER_SIZE, b"\x00")
 
-        while offset < len(buffer):
-            # Set the command in the buffer
-            cdu_buffer[0] = (command & 0x00FF)
-            cdu_buffer[1] = (command & 0xFF00) >> 8
+            # Send the command, offset and chunk to aXiom to process
+            self.__cdu_command(usage, CDU_Common.CDU_CMD_STORE, param1=offset, payload=payload)
 
-            # Set the offset into the buffer
-            cdu_buffer[4] = (offset & 0x00FF)
-            cdu_buffer[5] = (offset & 0xFF00) >> 8
-
-            # Add the chunk to the buffer. If the chunk to write is less than
-            # CDU_XFER_SIZE bytes, pad it out with 0s to CDU_XFER_SIZE bytes
-            if (offset + CDU_Common.CDU_XFER_SIZE) < len(buffer):
-                cdu_buffer[8:] = buffer[offset:offset + CDU_Common.CDU_XFER_SIZE]
-            else:
-                cdu_buffer[8:] = buffer[offset:]
-                padding_length = CDU_Common.CDU_XFER_SIZE - len(cdu_buffer[8:])
-                padding = [0x00] * padding_length
-                cdu_buffer += padding
-
-            # Send the command to aXiom to process
-            self.__axiom.write_usage(usage, cdu_buffer)
+            # Wait for the data to be transferred
+            self.__cdu_wait(usage, "store")
 
+            offset += CDU_Common.CDU_XFER_SIZE
+            stored += len(chunk)
+
+        return stored
+
+    def get_geometry(self, usage):
+        """
+        Returns the CDU's (param0, param1, param2) as reported by a query, querying aXiom only if
+        the geometry is not already known.
+        """
+        geometry = self._geometry.get(usage)
+        if geometry is None:
+            geometry = self.__cdu_query(usage)
+            self._geometry[usage] = geometry
+        return geometry
+
+    def get_length(self, usage):
+        param0, param1, param2 = self.get_geometry(usage)
+
+        # Length in bytes is param0 * param1, param 2 is not used
+        # Unfortunately, u93 is still a special case - this should be
+        # addressed in the future
+        if usage != 0x93:
+            return param0 * param1
+        else:
+            return param1 * param2
+
+    def invalidate_geometry(self, usage=None):
+        # Forgets the geometry of one CDU, or of all CDUs when usage is None
+        if usage is None:
+            self._geometry = {}
+        else:
+            self._geometry.pop(usage, None)
+
+    def commit(self, usage, timeout=None):
+        """
+        Commits the content previously stored with store_from() to the CDU's non-volatile memory.
+        timeout overrides COMMIT_TIMEOUT, in seconds, for this commit.
+        """
+        self.__cdu_commit(usage, timeout)
+
+    @staticmethod
+    def __iter_chunks(source):
+        # Splits the source into CDU_XFER_SIZE chunks
+        if isinstance(source, (bytes, bytearray, memoryview, list, tuple)):
+            for offset in range(0, len(source), CDU_Common.CDU_XFER_SIZE):
+                yield source[offset:offset + CDU_Common.CDU_XFER_SIZE]
+        elif hasattr(source, "read"):
+            # Raw and unbuffered streams may return fewer bytes than asked for, keep reading
+            # until a whole chunk has been collected or the end of the stream is reached
             while True:
-                cdu_buffer = self.__axiom.read_usage(usage)
-                status = cdu_buffer[0] | (cdu_buffer[1] << 8)
-
-                if status == 0:
-                    # Data was successfully transferred
+                chunk = bytearray()
+                while len(chunk) < CDU_Common.CDU_XFER_SIZE:
+                    data = source.read(CDU_Common.CDU_XFER_SIZE - len(chunk))
+                    if not data:
+                        break
+                    chunk += data
+                if not chunk:
                     break
-                elif (status & CDU_Common.CDU_ERROR_MASK) != 0:
-                    print("ERROR: CDU Store Failure! Status: " + hex(status))
+                yield bytes(chunk)
+                if len(chunk) < CDU_Common.CDU_XFER_SIZE:
+                    break
+        else:
+            pending = bytearray()
+            for data in source:
+                # bytes(n) of an int would be n zero bytes, so single byte values are appended as is
+                if isinstance(data, int):
+                    pending.append(data)
                 else:
-                    # aXiom is still processing the request
-                    pass
-
-            offset += CDU_Common.CDU_XFER_SIZE
-
-    def __cdu_commit(self, usage):
-        cdu_buffer = [0x00] * self.__axiom.get_usage_length(usage)
-        command = CDU_Common.CDU_CMD_COMMIT  # COMMIT to NVM
-
-        # Set the command in the buffer and set up the magic values
-        cdu_buffer[0] = (command & 0x00FF)
-        cdu_buffer[1] = (command & 0xFF00) >> 8
-        cdu_buffer[2] = 0x0C
-        cdu_buffer[3] = 0xB1
-        cdu_buffer[4] = 0xDE
-        cdu_buffer[5] = 0xC0
-
-        # Send the command to aXiom to process
-        self.__axiom.write_usage(usage, cdu_buffer)
-
-        # Long sleep to allow for enough time to write the data to flash
-        sleep(0.5)
-
-        while True:
-            cdu_buffer = self.__axiom.read_usage(usage)
+                    pending.extend(data)
+                while len(pending) >= CDU_Common.CDU_XFER_SIZE:
+                    yield bytes(pending[:CDU_Common.CDU_XFER_SIZE])
+                    del pending[:CDU_Common.CDU_XFER_SIZE]
+            if pending:
+                yield bytes(pending)
 
+    def __cdu_query(self, usage):
+        self.__cdu_command(usage, CDU_Common.CDU_CMD_QUERY)
+
+        # Query completed OK
+        cdu_header = self.__cdu_wait(usage, "query", CDU_Common.CDU_HEADER_SIZE)
+        param0 = cdu_header[2] | (cdu_header[3] << 8)
+        param1 = cdu_header[4] | (cdu_header[5] << 8)
+        param2 = cdu_header[6] | (cdu_header[7] << 8)
+
+        return param0, param1, param2
+
+    def __cdu_commit(self, usage, timeout=None):
+        # The committed content may have a different geometry and CRC
+        self.invalidate_geometry(usage)
+        self.__axiom.invalidate_cdu_crcs()
+
+        # COMMIT to NVM, param0 and param1 hold the magic values
+        self.__cdu_command(usage, CDU_Common.CDU_CMD_COMMIT, param0=0xB10C, param1=0xC0DE)
+
+        # Wait for the data to be written to flash
+        try:
+            self.__cdu_wait(usage, "commit", timeout=self.COMMIT_TIMEOUT if timeout is None else timeout)
+        finally:
+            self.commit_durations.setdefault(usage, []).append(self.pollers["commit"].wait_time)
+
+    def __cdu_command(self, usage, command, param0=0, param1=0, param2=0, payload=None):
+        # Only the header, and the payload if there is one, is written. The CDU reports its own
+        # status, so the u02 write progress check is skipped.
+        cdu_buffer = [command & 0x00FF, (command & 0xFF00) >> 8,
+                      param0 & 0x00FF, (param0 & 0xFF00) >> 8,
+                      param1 & 0x00FF, (param1 & 0xFF00) >> 8,
+                      param2 & 0x00FF, (param2 & 0xFF00) >> 8]
+        if payload is not None:
+            cdu_buffer += payload
+
+        self.__axiom.write_usage_range(usage, 0, cdu_buffer, check_progress=False)
+
+    def __cdu_wait(self, usage, operation, length=2, timeout=None):
+        # Polls the CDU until aXiom has processed the command. Each poll reads only the first length
+        # bytes of the usage: the status word, plus the header and payload for commands that return data.
+        def check():
+            cdu_buffer = self.__axiom.read_usage_range(usage, 0, length)
             status = cdu_buffer[0] | (cdu_buffer[1] << 8)
+
             if status == 0:
-                # Data was successfully transferred
-                break
+                return cdu_buffer
             elif (status & CDU_Common.CDU_ERROR_MASK) != 0:
-                print("ERROR: CDU Commit Failure! Status: " + hex(status))
+                error = CDU_Error(usage, operation, status)
+                print("ERROR: " + str(error))
+                raise error
             else:
                 # aXiom is still processing the request
-                pass
+                return None
+
+        try:
+            return self.pollers[operation].poll(check, timeout)
+        except TimeoutError:
+            error = CDU_Error(usage, operation, None)
+            print("ERROR: " + str(error))
+            raise error
@@ -0,0 +1,40 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+
+def call_optional_comms_method(comms, name):
+    # begin_write_batch, end_write_batch and flush_write_acks are optional, comms interfaces
+    # without them write synchronously and there is nothing to do.
+    method = getattr(comms, name, None)
+    if method is not None:
+        method()
+
+
+class CommsCapabilities:
+    """
+    Describes what a comms interface can carry, so transfers can be sized for it rather than for
+    the smallest bus. Each comms interface exposes one as its capabilities attribute.
+
+    max_write_payload:   Largest payload write_page() accepts in one call.
+    max_read_payload:    Largest length read_page() accepts in one call.
+    max_transfer_length: Largest payload carried in a single bus transaction. A longer write_page()
+                         is split into several transactions at consecutive addresses, which the
+                         bootloader FIFO cannot accept.
+    header_overhead:     Protocol bytes sent alongside each transaction's payload.
+    supports_pipelining: True if several transactions can be in flight at once.
+    """
+    def __init__(self, max_write_payload, max_read_payload, max_transfer_length, header_overhead,
+                 supports_pipelining=False):
+        self.max_write_payload = max_write_payload
+        self.max_read_payload = max_read_payload
+        self.max_transfer_length = max_transfer_length
+        self.header_overhead = header_overhead
+        self.supports_pipelining = supports_pipelining
+
+    def __repr__(self):
+        return ("CommsCapabilities(max_write_payload=%d, max_read_payload=%d, max_transfer_length=%d, "
+                "header_overhead=%d, supports_pipelining=%s)" % (self.max_write_payload, self.max_read_payload,
+                                                                 self.max_transfer_length, self.header_overhead,
+                                                                 self.supports_pipelining))
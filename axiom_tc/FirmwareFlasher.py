@@ -0,0 +1,73 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+from .Bootloader import Bootloader
+from .FirmwareImage import FirmwareImage
+from .u33_CRCData import u33_CRCData
+
+
+class FirmwareFlasher:
+    """
+    Flashes firmware only when aXiom is not already running it. The firmware version, variant and
+    status in u31 and the runtime CRC in u33 are compared with the image's AXFW header first, the
+    download is skipped if they all match. ALC images carry no metadata, so they are always flashed,
+    as is a device found in bootloader mode.
+
+    The number of devices flashed and skipped is counted across calls.
+    """
+    def __init__(self, axiom):
+        self._axiom = axiom
+        self.flashed = 0
+        self.skipped = 0
+
+    def is_running(self, image):
+        """
+        Returns True if aXiom is running the firmware in image, a FirmwareImage.
+        """
+        if not image.is_axfw:
+            return False
+
+        # In bootloader mode there is no runtime firmware to compare. This also refreshes u31 page 0.
+        if self._axiom.is_in_bootloader_mode():
+            return False
+
+        u31 = self._axiom.u31
+        if not u31.usage_table_populated:
+            u31.build_usage_table()
+
+        if (u31.reg_fw_major, u31.reg_fw_minor, u31.reg_fw_variant, u31.reg_fw_status) != \
+                (image.fw_major, image.fw_minor, image.fw_variant, image.fw_status):
+            return False
+
+        # Engineering builds can share a version number, the runtime CRC tells them apart
+        return u33_CRCData(self._axiom).reg_runtime_crc == image.fw_crc
+
+    def flash(self, path_or_fileobj, progress_callback=None, force=False):
+        """
+        Flashes the firmware unless aXiom is already running it.
+
+        Parameters:
+        path_or_fileobj: Path to an .axfw or .alc file, a binary file object or a FirmwareImage.
+        progress_callback: Passed on to Bootloader.flash().
+        force: Flash even if aXiom is already running the firmware.
+
+        Returns True if the firmware was flashed, False if it was skipped.
+        """
+        if isinstance(path_or_fileobj, FirmwareImage):
+            image = path_or_fileobj
+        else:
+            image = FirmwareImage(path_or_fileobj)
+
+        try:
+            if (not force) and self.is_running(image):
+                self.skipped += 1
+                return False
+
+            Bootloader(self._axiom, self._axiom._comms).flash(image, progress_callback)
+            self.flashed += 1
+            return True
+        finally:
+            if image is not path_or_fileobj:
+                image.close()
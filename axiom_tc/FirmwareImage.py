@@ -0,0 +1,112 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+import mmap
+import os
+import struct
+
+
+class FirmwareImage:
+    """
+    Read only view of an aXiom firmware file, either an .axfw file (a header followed by chunks) or
+    a bare .alc chunk file. The file is memory mapped where possible and chunks are returned as
+    memoryview slices of it, so the image is never copied into Python lists.
+
+    Each chunk is an 8 byte header, whose last two bytes hold the big endian length of the payload
+    that follows. A chunk is written to the bootloader as is, header included.
+    """
+    AXFW_SIGNATURE = b"AXFW"
+    AXFW_HEADER_FORMAT = "<4sIHHBBBBBHBI"
+    AXFW_HEADER_LEN = struct.calcsize(AXFW_HEADER_FORMAT)
+
+    CHUNK_HEADER_LEN = 8
+
+    def __init__(self, path_or_fileobj):
+        self._file = None
+        self._mmap = None
+
+        if isinstance(path_or_fileobj, (str, bytes, os.PathLike)):
+            self._file = open(path_or_fileobj, "rb")
+            data = self._map(self._file)
+        else:
+            data = self._map(path_or_fileobj)
+            if data is None:
+                # Not backed by a file, e.g. a BytesIO, read it in one go
+                data = path_or_fileobj.read()
+
+        if data is None:
+            data = b""
+        self._data = memoryview(data)
+
+        self.is_axfw = (self._data[:4] == self.AXFW_SIGNATURE)
+        if self.is_axfw:
+            if len(self._data) < self.AXFW_HEADER_LEN:
+                raise ValueError("Firmware file is too short for an AXFW header")
+            (_, self.file_crc, self.file_format_version, self.device_id, self.fw_variant, self.fw_minor,
+             self.fw_major, self.fw_rc, self.fw_status, self.silicon_version, self.silicon_revision,
+             self.fw_crc) = struct.unpack_from(self.AXFW_HEADER_FORMAT, self._data)
+            self._chunks_offset = self.AXFW_HEADER_LEN
+        else:
+            # ALC files have no header, so nothing is known about the firmware they contain
+            self.file_crc = self.file_format_version = self.device_id = None
+            self.fw_variant = self.fw_minor = self.fw_major = self.fw_rc = self.fw_status = None
+            self.silicon_version = self.silicon_revision = self.fw_crc = None
+            self._chunks_offset = 0
+
+    def _map(self, fileobj):
+        try:
+            fileno = fileobj.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+        if os.fstat(fileno).st_size == 0:
+            return b""  # Empty files cannot be memory mapped
+        self._mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    @property
+    def size(self):
+        # Number of bytes that will be written to the bootloader
+        return len(self._data) - self._chunks_offset
+
+    def chunks(self):
+        """
+        Yields each chunk, header included, as a memoryview into the image.
+
+        Raises:
+        ValueError: If a chunk runs past the end of the file.
+        """
+        offset = self._chunks_offset
+        end = len(self._data)
+
+        while offset < end:
+            if (offset + self.CHUNK_HEADER_LEN) > end:
+                raise ValueError("Truncated chunk header at offset 0x%X" % offset)
+
+            payload_length = (self._data[offset + 6] << 8) | self._data[offset + 7]
+            chunk_end = offset + self.CHUNK_HEADER_LEN + payload_length
+            if chunk_end > end:
+                raise ValueError("Chunk at offset 0x%X runs past the end of the file" % offset)
+
+            yield self._data[offset:chunk_end]
+            offset = chunk_end
+
+    def close(self):
+        self._data.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # A chunk is still referenced, the mapping is released along with it
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,145 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .axiom import axiom
+from .FirmwareFlasher import FirmwareFlasher
+
+
+class FleetDeviceResult:
+    """
+    Outcome of flashing one device. flashed is True if the firmware was loaded, False if the device
+    was already running it, and None if the device failed, in which case error holds the exception.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.flashed = None
+        self.error = None
+        self.bytes_written = 0
+        self.duration = 0.0
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def __repr__(self):
+        if self.failed:
+            outcome = "failed: %s" % self.error
+        else:
+            outcome = "flashed" if self.flashed else "skipped"
+        return "%s: %s in %.2fs" % (self.name, outcome, self.duration)
+
+
+class FleetFlasher:
+    """
+    Flashes the same firmware onto several devices at once, one thread per device. Each device is
+    described by a factory that opens its comms interface, so USB bridges, I2C and SPI buses can be
+    mixed. A device that fails does not affect the others, its error is kept in its result.
+
+    Devices already running the firmware are skipped, see FirmwareFlasher.
+    """
+    def __init__(self, comms_factories, max_workers=None):
+        """
+        Parameters:
+        comms_factories: dict of device name to a callable returning an open comms object, or a list
+                         of callables, named by their position. For example
+                         {"i2c-1": lambda: I2C_Comms(1, 0x66), "i2c-2": lambda: I2C_Comms(2, 0x66)}
+        max_workers: Most devices flashed at once, defaults to all of them.
+        """
+        if not isinstance(comms_factories, dict):
+            comms_factories = {str(index): factory for index, factory in enumerate(comms_factories)}
+        self._comms_factories = comms_factories
+        self.max_workers = max_workers if max_workers is not None else max(1, len(comms_factories))
+
+        self.results = []
+        self.elapsed = 0.0
+
+    @classmethod
+    def for_usb_bridges(cls, max_workers=None, **usb_options):
+        """
+        Returns a FleetFlasher for every connected USB protocol bridge. usb_options are passed on
+        to USB_Comms, e.g. pipelined=True.
+        """
+        # Taken from the package, which only imports USB_Comms (and hid) on first use
+        from . import USB_Comms
+
+        factories = {}
+        for path in USB_Comms.enumerate_bridges():
+            name = path.decode(errors="replace") if isinstance(path, bytes) else str(path)
+            factories[name] = (lambda p=path: USB_Comms(path=p, **usb_options))
+        return cls(factories, max_workers)
+
+    def flash(self, path, progress_callback=None, force=False):
+        """
+        Flashes the firmware file at path onto every device and returns a FleetDeviceResult per device.
+
+        Parameters:
+        path: Path to an .axfw or .alc file. Each device maps the file separately.
+        progress_callback: Optional, called from the worker threads as
+                           progress_callback(name, bytes_written, total_bytes, bytes_per_second, eta_seconds).
+        force: Flash even if a device is already running the firmware.
+        """
+        start = time.perf_counter()
+        progress_lock = threading.Lock()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._flash_device, name, factory, path, progress_callback, progress_lock,
+                                       force)
+                       for name, factory in self._comms_factories.items()]
+            self.results = [future.result() for future in futures]
+
+        self.elapsed = time.perf_counter() - start
+        return self.results
+
+    def _flash_device(self, name, factory, path, progress_callback, progress_lock, force):
+        result = FleetDeviceResult(name)
+        start = time.perf_counter()
+        comms = None
+
+        def progress(bytes_written, total_bytes, bytes_per_second, eta):
+            result.bytes_written = bytes_written
+            if progress_callback is not None:
+                # Callbacks are serialised, so they do not need to be thread safe
+                with progress_lock:
+                    progress_callback(name, bytes_written, total_bytes, bytes_per_second, eta)
+
+        try:
+            comms = factory()
+            result.flashed = FirmwareFlasher(axiom(comms)).flash(path, progress, force)
+        except (Exception, SystemExit) as error:  # USB_Comms exits when it cannot find its bridge
+            result.error = error
+        finally:
+            if comms is not None:
+                try:
+                    comms.close()
+                except Exception:
+                    pass  # The device's result already says whether it was flashed
+            result.duration = time.perf_counter() - start
+
+        return result
+
+    @property
+    def flashed(self):
+        return sum(1 for result in self.results if result.flashed)
+
+    @property
+    def skipped(self):
+        return sum(1 for result in self.results if result.flashed is False)
+
+    @property
+    def failed(self):
+        return sum(1 for result in self.results if result.failed)
+
+    @property
+    def bytes_written(self):
+        return sum(result.bytes_written for result in self.results)
+
+    @property
+    def bytes_per_second(self):
+        # Aggregate throughput of the last flash() across all devices
+        return (self.bytes_written / self.elapsed) if self.elapsed > 0 else 0.0
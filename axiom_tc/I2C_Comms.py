@@ -5,8 +5,19 @@
 
 from smbus2 import SMBus, i2c_msg
 
+from .CommsCapabilities import CommsCapabilities
+
 
 class I2C_Comms:
+    # Largest transfer that can be carried in a single transaction. i2c-dev rejects
+    # messages longer than 8192 bytes and writes also carry the 4 byte aXiom header.
+    MAX_READ_LENGTH = 8192
+    MAX_WRITE_LENGTH = 8192 - 4
+
+    # Every write_page/read_page is a single transaction carrying the 4 byte aXiom header
+    capabilities = CommsCapabilities(max_write_payload=MAX_WRITE_LENGTH, max_read_payload=MAX_READ_LENGTH,
+                                     max_transfer_length=MAX_WRITE_LENGTH, header_overhead=4)
+
     def __init__(self, bus, address):
         self._addr = address
         self._bus = SMBus(bus)
@@ -44,7 +55,7 @@ class I2C_Comms:
         length_msb &= ~0x80  # Ensure the read bit is clear
 
         write_header = [ta_lsb, ta_msb, length_lsb, length_msb]
-        write_payload = payload
+        write_payload = list(payload)  # Payloads may be bytes-like, e.g. a view into a firmware image
         write = write_header + write_payload
 
         wr = i2c_msg.write(self._addr, write)
@@ -53,5 +64,15 @@ class I2C_Comms:
         except IOError:
             pass  # Silently handle IOError. Typically, see this when in bootloader mode
 
+    # Writes complete synchronously on this bus, there are no acknowledgements to defer
+    def begin_write_batch(self):
+        pass
+
+    def end_write_batch(self):
+        pass
+
+    def flush_write_acks(self):
+        pass
+
     def close(self):
         self._bus.close()
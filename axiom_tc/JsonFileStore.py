@@ -0,0 +1,49 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+import json
+import os
+import tempfile
+
+
+class JsonFileStore:
+    """
+    A dictionary of entries kept in a JSON file, shared by the on-disk caches. The file records a
+    format version, a file with a different version, or one that is missing or corrupt, loads as empty.
+    Saves are atomic, other processes never see a partially written file.
+    """
+    def __init__(self, path, format_version):
+        self.path = path
+        self.format_version = format_version
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                content = json.load(f)
+            if content.get("format") == self.format_version:
+                return content.get("entries", {})
+        except (OSError, ValueError):
+            pass  # A missing or corrupt file is treated as empty, it will be rebuilt
+        return {}
+
+    def save(self, entries):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file and swap it in, so other processes never see a partial file.
+        # The temporary file is unique to this save, threads saving the same path do not share it.
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + ".",
+                                         suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"format": self.format_version, "entries": entries}, f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,120 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+import os
+import time
+
+# Resolved on first use by precise_sleep()
+_precise_sleep_impl = None
+
+
+def precise_sleep(duration_seconds):
+    """
+    Sleeps for a short duration more precisely than time.sleep(), which can take well over 1ms
+    to return on some platforms. The platform's sleep function is looked up once.
+    """
+    global _precise_sleep_impl
+    if _precise_sleep_impl is None:
+        _precise_sleep_impl = _resolve_precise_sleep()
+    _precise_sleep_impl(duration_seconds)
+
+
+def _resolve_precise_sleep():
+    import ctypes
+    import ctypes.util
+
+    if os.name == 'nt':  # Windows
+        winmm = ctypes.windll.winmm
+
+        def sleep(duration_seconds):
+            winmm.timeBeginPeriod(1)
+            time.sleep(duration_seconds)
+            winmm.timeEndPeriod(1)
+        return sleep
+
+    if os.name == 'posix':  # Linux/Unix
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is not None:
+            usleep = ctypes.CDLL(libc_name).usleep
+
+            def sleep(duration_seconds):
+                usleep(int(duration_seconds * 1_000_000))  # Convert seconds to microseconds
+            return sleep
+
+    # An alternative approach to sleep for a precise duration
+    # This approach can be CPU intensive.
+    def sleep(duration_seconds):
+        start = time.perf_counter()
+        while (time.perf_counter() - start) < duration_seconds:
+            pass
+    return sleep
+
+
+class Poller:
+    """
+    Polls aXiom for the completion of an operation. The first few polls are issued back to back to
+    catch operations that complete almost immediately, after that the sleep between polls grows
+    exponentially up to max_delay until the operation completes or the timeout expires.
+
+    The number of polls and the time spent waiting are recorded for the last operation and in total,
+    so the parameters can be tuned for each bus. sleep can be replaced, e.g. with precise_sleep for
+    delays of around a millisecond.
+    """
+    def __init__(self, timeout, spin_polls=2, initial_delay=0.0005, max_delay=0.01, backoff=2.0, sleep=time.sleep):
+        self.timeout = timeout
+        self.spin_polls = spin_polls
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.sleep = sleep
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        # Last operation
+        self.polls = 0
+        self.wait_time = 0.0
+
+        # All operations since the stats were reset
+        self.operations = 0
+        self.total_polls = 0
+        self.total_wait_time = 0.0
+
+    def poll(self, check, timeout=None):
+        """
+        Calls check() until it returns a value other than None, and returns that value.
+
+        Parameters:
+        check: Callable that polls the device once. Returns None while the operation is in progress.
+        timeout: Overrides the poller's timeout, in seconds, for this operation.
+
+        Raises:
+        TimeoutError: If the operation has not completed before the timeout expires.
+        """
+        start = time.perf_counter()
+        deadline = start + (self.timeout if timeout is None else timeout)
+        delay = self.initial_delay
+        polls = 0
+
+        try:
+            while True:
+                result = check()
+                polls += 1
+                if result is not None:
+                    return result
+
+                now = time.perf_counter()
+                if now >= deadline:
+                    raise TimeoutError("Operation did not complete within %.3fs" % (now - start))
+
+                if polls > self.spin_polls:
+                    self.sleep(min(delay, deadline - now))
+                    delay = min(delay * self.backoff, self.max_delay)
+        finally:
+            self.polls = polls
+            self.wait_time = time.perf_counter() - start
+            self.operations += 1
+            self.total_polls += polls
+            self.total_wait_time += self.wait_time
@@ -6,8 +6,19 @@
 import spidev
 from time import sleep
 
+from .CommsCapabilities import CommsCapabilities
+
 
 class SPI_Comms:
+    # Largest transfer that can be carried in a single transaction. spidev's default
+    # buffer is 4096 bytes, which also has to hold the 4 byte header and 32 bytes of padding.
+    MAX_READ_LENGTH = 4096 - 36
+    MAX_WRITE_LENGTH = 4096 - 36
+
+    # Every write_page/read_page is a single transaction carrying the header and padding
+    capabilities = CommsCapabilities(max_write_payload=MAX_WRITE_LENGTH, max_read_payload=MAX_READ_LENGTH,
+                                     max_transfer_length=MAX_WRITE_LENGTH, header_overhead=36)
+
     def __init__(self, bus, device):
         self._spi = spidev.SpiDev()
         self._spi.open(bus, device)
@@ -54,10 +65,20 @@ class SPI_Comms:
 
         spi_header = [ta_lsb, ta_msb, length_lsb, length_msb]
         spi_padding = [0x00] * 32
-        spi_body = payload
+        spi_body = list(payload)  # Payloads may be bytes-like, e.g. a view into a firmware image
         spi_op = spi_header + spi_padding + spi_body
         self._spi.xfer(spi_op)
         sleep(0.001)
 
+    # Writes complete synchronously on this bus, there are no acknowledgements to defer
+    def begin_write_batch(self):
+        pass
+
+    def end_write_batch(self):
+        pass
+
+    def flush_write_acks(self):
+        pass
+
     def close(self):
         self._spi.close()
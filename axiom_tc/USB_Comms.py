@@ -4,7 +4,11 @@
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
 import hid
+import struct
 import sys
+from collections import deque
+
+from .CommsCapabilities import CommsCapabilities
 
 
 def byte2ascii(buffer):
@@ -42,6 +46,11 @@ class USB_Comms:
     AX_TBP_USBID_UNSOLICITED = 0x9A  # "unsolicited" report from the bridge when in Proxy Mode.
     AX_CMD_RESET = 0xEF
 
+    # Largest transfer read_page/write_page will accept in one call, limited by the 15 bit
+    # length field in the aXiom header. Longer transfers are split into HID reports here.
+    MAX_READ_LENGTH = 0x7FFF
+    MAX_WRITE_LENGTH = 0x7FFF
+
     # Maximum payload size for USB bridge commands 0x51 and 0x52
     AX_TBP_I2C_DEV_HEAD_LEN = 3
 
@@ -68,18 +77,41 @@ class USB_Comms:
     @property
     def EMPTY_PKT(self):
         return [self.REPORT_ID] + [0]*(self.MAX_WR_BUFFER_SIZE -1)
+    # Number of TBP requests kept in flight when pipelining is enabled, per bridge type.
+    # Responses are always matched to requests in the order they were issued.
+    PIPELINE_DEPTH = {
+        'TNxPB-005': 2,
+        'TNxPB-007': 4,
+        'AXPB009': 4,
+        'AXPB015': 4,
+    }
+    # Upper limit on write acknowledgements left unread in deferred mode, this keeps the
+    # responses within what the bridge and the host HID driver can queue.
+    MAX_DEFERRED_ACKS = 16
     RD_TIMEOUT = 100
     MAX_TBP_STOP_RETRY = 2
     RD_BASE = 0
     REPORT_ID = 0x00  # Report ID for the USB Bridge
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, pipelined=False, defer_write_acks=False, path=None):
         self._axiom = None
+        # Stop-and-wait unless pipelining is requested and the bridge is known to support it
+        self.pipeline_depth = 1
+
+        # When deferred, write acknowledgements are collected at the end of write_page() or at
+        # the end of a write batch, rather than after each report. Addresses of the writes that
+        # are still waiting for their acknowledgement are kept, in issue order, in _pending_acks.
+        self.defer_write_acks = defer_write_acks
+        self._pending_acks = deque()
+        self._write_batch_depth = 0
         # Check for a connected bridge
         # If multiple bridges are connected, the priority is as follows:
         # ATMEL -> ST -> GD
         for VID in self.VENDOR_ID:
             usb_devices = hid.enumerate(VID)
+            if path is not None:
+                # Only the requested bridge, e.g. one of the paths from enumerate_bridges()
+                usb_devices = [dev for dev in usb_devices if dev['path'] == path]
             self.max_length = 0
             self._verbose = verbose
             if len(usb_devices) != 0:
@@ -126,8 +158,13 @@ class USB_Comms:
                         self.max_rd_pay_length = self.max_rd_pay_length - 1
                         self.RD_BASE = 1 # include the report ID in the read buffer
                         self.REPORT_ID = 0x01
+                    if pipelined:
+                        for product, depth in self.PIPELINE_DEPTH.items():
+                            if product in dev['product_string']:
+                                self.pipeline_depth = depth
                     if self._verbose:
                         print('Max Write Length: ' + str(self.max_wr_pay_length))
+                        print('Pipeline Depth: ' + str(self.pipeline_depth))
                         print('Max Read Length: ' + str(self.max_rd_pay_length))
             try:  # Fail gracefully if the USB object can't be acquired
                 if self.__device:
@@ -136,6 +173,20 @@ class USB_Comms:
                 print("ERROR: USB device could not be acquired. The device might already in use.")
                 sys.exit(1)
 
+        # Preallocated HID reports, reused for every transfer. The read report only ever has
+        # its header rewritten, the write report has its payload and padding rewritten.
+        self._rd_report = bytearray(self.hidPayloadSize)
+        self._wr_report = bytearray(self.hidPayloadSize)
+        self._zero_report = memoryview(bytes(self.hidPayloadSize))
+
+        # Each HID report carries the report ID, the 3 byte bridge header and the 4 byte aXiom
+        # header, leaving max_wr_pay_length bytes for the payload
+        self.capabilities = CommsCapabilities(max_write_payload=self.MAX_WRITE_LENGTH,
+                                              max_read_payload=self.MAX_READ_LENGTH,
+                                              max_transfer_length=self.max_wr_pay_length,
+                                              header_overhead=1 + self.AX_USB_HEADER_LEN + self.AX_HEADER_LEN,
+                                              supports_pipelining=self.pipeline_depth > 1)
+
     def stop_bridge(self):
         if self._verbose:
             print("    Stopping Proxy Mode...")
@@ -169,72 +220,93 @@ class USB_Comms:
         self._axiom = axiom
         self.stop_bridge()
 
+    @classmethod
+    def enumerate_bridges(cls):
+        """
+        Returns the HID path of every connected protocol bridge, in the same vendor priority order
+        the constructor uses. Pass a path to the constructor to open that bridge.
+        """
+        paths = []
+        for VID in cls.VENDOR_ID:
+            for dev in hid.enumerate(VID):
+                if dev['interface_number'] == cls.AX_IF_TBPCTRL and dev['usage_page'] == 0xffff:
+                    paths.append(dev['path'])
+        return paths
+
     def read_page(self, target_address, length):
-        # if length > (self.max_rd_pay_length):
-        #    print("ERROR: Asked to read more bytes than available in payload: ")
-        #    print("Requested length: %d, allowed is %d" % (length, self.max_rd_pay_length))
-        #    raise ValueError
+        # Compatibility shim, callers that can consume bytes should use read_page_bytes()
+        return list(self.read_page_bytes(target_address, length))
 
+    def read_page_bytes(self, target_address, length):
+        ret_buffer = bytearray(length)
+        self.read_page_into(target_address, length, ret_buffer)
+        return ret_buffer
+
+    def read_page_into(self, target_address, length, out):
+        # Reads length bytes from target_address into the writable buffer out (bytearray,
+        # memoryview etc.). Each HID response is copied straight into its slot in out.
         if self._verbose:
             print("\nUSB Read request at add: 0x%x, length: %d" % (target_address, length))
 
-        left_to_transfer = length
-        to_address = target_address
-
-        ret_buffer = []
-
-        while left_to_transfer > 0:
+        out_view = memoryview(out)
+        if len(out_view) < length:
+            print("ERROR: Output buffer too small, requested %d, buffer is %d." % (length, len(out_view)))
+            raise AssertionError
 
-            if left_to_transfer >= self.max_rd_pay_length:
-                to_transfer = self.max_rd_pay_length
-                left_to_transfer = left_to_transfer - self.max_rd_pay_length
-                ta_msb = (to_address & 0xFF00) >> 8
-                ta_lsb = (to_address & 0x00FF)
+        report = self._rd_report
+        base = self.RD_BASE + 2
+        in_flight = deque()
+        offset = 0
+
+        while (offset < length) or in_flight or self._pending_acks:
+            # Keep up to pipeline_depth requests queued in the bridge before collecting a response.
+            # Any outstanding write acknowledgements are ahead of the reads in the queue.
+            if (offset < length) and ((len(in_flight) + len(self._pending_acks)) < self.pipeline_depth):
+                to_transfer = min(length - offset, self.max_rd_pay_length)
+                to_address = target_address + offset
+
+                # usb header: report id, command, write length, read length
+                # payload header: target address, length with the READ bit set
+                struct.pack_into("<4B2H", report, 0, self.REPORT_ID, self.AX_TBP_I2C_DEVICE1, self.AX_HEADER_LEN,
+                                 to_transfer, to_address & 0xFFFF,
+                                 (to_transfer & 0x7FFF) | (self.AX_COMMS_READ << 8))
                 if self._verbose:
+                    print("Reading from device...")
                     print("Address 0x%x" % to_address)
-                to_address = to_address + to_transfer
-
-            else:
-                to_transfer = left_to_transfer
-                left_to_transfer = 0
-                ta_msb = (to_address & 0xFF00) >> 8
-                ta_lsb = (to_address & 0x00FF)
-
-            length_msb = (to_transfer & 0x7F00) >> 8
-            length_lsb = (to_transfer & 0x00FF)
-
-            length_msb |= self.AX_COMMS_READ  # Set the READ bit
-
-            usb_header = [self.REPORT_ID, self.AX_TBP_I2C_DEVICE1, self.AX_HEADER_LEN, to_transfer]
-            payload_header = [ta_lsb, ta_msb, length_lsb, length_msb]
-            message = usb_header + payload_header
-            wr_buffer = message + ([0] * (self.hidPayloadSize - len(message)))
-            if self._verbose:
-                print("Reading from device...")
-                print("rd usb_header: ", byte2ascii(usb_header))
-                print("rd payload_header: ", byte2ascii(payload_header))
-                # print("message: ", message)
-                # print("write %d chars to device..." % len(wr_buffer))
-            self.__device.write(bytes(wr_buffer))
-            rd_buffer = self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
-            assert rd_buffer[self.RD_BASE + 0] == self.AX_TBP_RDWR_OK
-            assert rd_buffer[self.RD_BASE + 1] == to_transfer
-            base = self.RD_BASE+2
+                    print("rd header: ", byte2ascii(report[0:8]))
+
+                # hid only accepts bytes, see write_device()
+                self.__device.write(bytes(report))
+                in_flight.append((to_address, offset, to_transfer))
+                offset += to_transfer
+                continue
+
+            try:
+                if self._pending_acks:
+                    self._complete_write_ack()
+                    continue
+
+                to_address, rd_offset, to_transfer = in_flight.popleft()
+                rd_buffer = self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
+                self._check_read_response(rd_buffer, to_address, to_transfer)
+            except (AssertionError, IOError):
+                # A failed read or deferred write acknowledgement. Collect the responses to the reads
+                # still in flight so the bridge's responses stay in step with the next request, as
+                # _complete_write_ack() does for writes.
+                while in_flight:
+                    in_flight.popleft()
+                    self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
+                raise
             if self._verbose:
                 print("Device Response:")
                 print("rd Buffer is of length: " + str(len(rd_buffer)))
-                print("rd Left to transfer: " + str(left_to_transfer))
+                print("rd Left to transfer: " + str(length - rd_offset - to_transfer))
                 print(byte2ascii(rd_buffer[base:base + to_transfer]))
 
-            ret_buffer = ret_buffer + byte2int(rd_buffer[base:base + to_transfer])
+            out_view[rd_offset:rd_offset + to_transfer] = memoryview(rd_buffer)[base:base + to_transfer]
 
-        if len(ret_buffer) != length:
-            print("ERROR: Did not return enough bytes, requested %d, returned %d." %
-                  (length, len(ret_buffer)))
-            raise AssertionError
         if self._verbose:
-            print("returning buffer ", byte2ascii(ret_buffer))
-        return list(ret_buffer)
+            print("returning buffer ", byte2ascii(out_view[0:length]))
 
     def write_page(self, target_address, length, payload):
         if length > len(payload):
@@ -242,55 +314,101 @@ class USB_Comms:
             print("Length: %d, and given payload is %d" % (length, len(payload)))
             raise AssertionError
 
+        # Lists of ints are still accepted, they are converted once here rather than per report
+        if not isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = bytes(payload)
+        payload_view = memoryview(payload)
+
         if self._verbose:
             print("\nUSB Write request at add: 0x%x, length: %d" % (target_address, length))
-            print("payload: ", byte2ascii(payload))
+            print("payload: ", byte2ascii(payload_view[0:length]))
 
-        left_to_transfer = length
-        to_address = target_address
-        transferred = 0
-        while left_to_transfer > 0:
-
-            if left_to_transfer >= self.max_wr_pay_length:
-                to_transfer = self.max_wr_pay_length
-                left_to_transfer = left_to_transfer - self.max_wr_pay_length
-                ta_msb = (to_address & 0xFF00) >> 8
-                ta_lsb = (to_address & 0x00FF)
-                to_address = to_address + to_transfer
+        report = self._wr_report
+        if self.defer_write_acks:
+            window = max(self.MAX_DEFERRED_ACKS, self.pipeline_depth)
+        else:
+            window = self.pipeline_depth
 
-            else:
-                to_transfer = left_to_transfer
-                left_to_transfer = 0
-                ta_msb = (to_address & 0xFF00) >> 8
-                ta_lsb = (to_address & 0x00FF)
-
-            length_msb = (to_transfer & 0x7F00) >> 8
-            length_lsb = (to_transfer & 0x00FF)
-
-            # Ensure the read bit is clear
-            # NOTE: Python does not do bit-wise not. Here we
-            #       subtract from 0xff to achieve that.
-            # credit to:
-            #     https://stackoverflow.com/questions/31151107/how-do-i-do-a-bitwise-not-operation-in-python
-            length_msb &= 0xFF - self.AX_COMMS_READ
-
-            usb_header = [0x00, self.AX_TBP_I2C_DEVICE1, to_transfer + self.AX_HEADER_LEN, 0x0]
-            payload_header = [ta_lsb, ta_msb, length_lsb, length_msb]
-            message = usb_header + payload_header + payload[transferred:transferred + to_transfer]
-            buffer = message + ([0] * (self.hidPayloadSize - len(message)))
+        transferred = 0
+        while transferred < length:
+            if len(self._pending_acks) >= window:
+                self._complete_write_ack()
+                continue
+
+            to_transfer = min(length - transferred, self.max_wr_pay_length)
+            to_address = target_address + transferred
+
+            # usb header: report id, command, write length, read length
+            # payload header: target address, length with the READ bit clear
+            struct.pack_into("<4B2H", report, 0, 0x00, self.AX_TBP_I2C_DEVICE1, to_transfer + self.AX_HEADER_LEN, 0x0,
+                             to_address & 0xFFFF, to_transfer & 0x7FFF)
+            message_end = self.AX_HEADER_LEN * 2 + to_transfer
+            report[self.AX_HEADER_LEN * 2:message_end] = payload_view[transferred:transferred + to_transfer]
+            report[message_end:] = self._zero_report[message_end:]
             if self._verbose:
                 print("Writing %d bytes to device..." % to_transfer)
-                print("wr usb_header: ", byte2ascii(usb_header))
-                print("wr payload_header: ", byte2ascii(payload_header))
-                # print("payload: ", byte2ascii(payload))
-                print("message: ", byte2ascii(message))
-                # print("len(buffer): %d, to_transfer: %d" % (len(buffer),to_transfer))
-            assert len(buffer) == self.hidPayloadSize
-            self.__device.write(bytes(buffer))
+                print("message: ", byte2ascii(report[0:message_end]))
+
+            # hid only accepts bytes, see write_device()
+            self.__device.write(bytes(report))
+            self._pending_acks.append(to_address)
             transferred = transferred + to_transfer
 
-            # We want to read from the bridge to clear the comms status, but don't need to use it.
-            _ = self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
+        # Deferred acknowledgements inside a write batch are left for end_write_batch()
+        if not (self.defer_write_acks and self._write_batch_depth > 0):
+            self.flush_write_acks()
+
+    def begin_write_batch(self):
+        self._write_batch_depth += 1
+
+    def end_write_batch(self):
+        self._write_batch_depth -= 1
+        if self._write_batch_depth == 0:
+            self.flush_write_acks()
+
+    def flush_write_acks(self):
+        while self._pending_acks:
+            self._complete_write_ack()
+
+    def _complete_write_ack(self):
+        to_address = self._pending_acks.popleft()
+        rd_buffer = self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
+
+        if len(rd_buffer) < (self.RD_BASE + 1):
+            status = None
+        else:
+            status = rd_buffer[self.RD_BASE + 0]
+
+        if status not in (self.AX_TBP_WR_OK, self.AX_TBP_RDWR_OK):
+            # Collect the remaining acknowledgements so the bridge's responses stay in step
+            # with the next request, then report the first failing chunk.
+            while self._pending_acks:
+                self._pending_acks.popleft()
+                self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
+
+            if status is None:
+                reason = "no response"
+            elif status == self.AX_TBP_NOACK_DATA:
+                reason = "data not acknowledged"
+            elif status == self.AX_TBP_NOACK_ADDR:
+                reason = "address not acknowledged"
+            else:
+                reason = "status 0x%02X" % status
+            print("ERROR: USB Bridge write failed at address 0x%04X, %s." % (to_address, reason))
+            raise IOError("USB Bridge write failed at address 0x%04X, %s" % (to_address, reason))
+
+    def _check_read_response(self, rd_buffer, to_address, to_transfer):
+        if len(rd_buffer) < (self.RD_BASE + 2):
+            print("ERROR: No response from USB Bridge reading address 0x%04X." % to_address)
+            raise AssertionError
+        if rd_buffer[self.RD_BASE + 0] != self.AX_TBP_RDWR_OK:
+            print("ERROR: USB Bridge read failed at address 0x%04X, status: 0x%02X." %
+                  (to_address, rd_buffer[self.RD_BASE + 0]))
+            raise AssertionError
+        if rd_buffer[self.RD_BASE + 1] != to_transfer:
+            print("ERROR: USB Bridge returned %d bytes reading address 0x%04X, expected %d." %
+                  (rd_buffer[self.RD_BASE + 1], to_address, to_transfer))
+            raise AssertionError
 
     def read_device(self):
         return self.__device.read(self.hidPayloadSize, timeout=self.RD_TIMEOUT)
@@ -302,6 +420,7 @@ class USB_Comms:
         self.__device.write(bytes(buffer[0:self.hidPayloadSize]))
 
     def set_proxy_mode(self):
+        self.flush_write_acks()
         if self._verbose:
             print("Setting USB bridge into Proxy Mode")
         target_address = self._axiom.u31.convert_usage_to_target_address(0x34, 0)
@@ -335,6 +454,7 @@ class USB_Comms:
             print("    Null Command Sent...")
 
     def close(self, doreset=False):
+        self.flush_write_acks()
         if self.pid == self.PRODUCT_ID[0]:
             # Only do this for tbp mode...
             self.set_proxy_mode()
@@ -19,10 +19,16 @@ class UsageRevisionBase:
         self.pack()
         if write_to_nvm:
             self._axiom.u02.send_command(self._axiom.u02.CMD_STOP)
-        self._axiom.config_write_usage_to_device(self._usage_id, self._usage_binary_data)
+        usage_content = self._axiom.config_write_usage_to_device(self._usage_id, self._usage_binary_data)
         if write_to_nvm:
             self._axiom.u02.send_command(self._axiom.u02.CMD_SAVE_CONFIG)
-        self.read()
+
+        # Reuse the content from the write rather than reading the usage a third time
+        if usage_content is not None:
+            self._usage_binary_data = usage_content
+            self.unpack()
+        else:
+            self.read()
 
     def print(self):
         self.print_registers()
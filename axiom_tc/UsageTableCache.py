@@ -0,0 +1,51 @@
+# Copyright (c) 2025 TouchNetix
+#
+# This file is part of axiom_tc and is released under the MIT License:
+# See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
+
+from .JsonFileStore import JsonFileStore
+
+
+class UsageTableCache:
+    """
+    Persistent, on-disk store of decoded usage tables. Entries are keyed by the device ID and
+    firmware version/variant/status reported in u31 page 0, and each entry records the u33 runtime
+    CRC of the firmware it was built from. An entry is only used when the runtime CRC read back
+    from the device still matches, so engineering builds that share a version number are not mixed up.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path):
+        self._store = JsonFileStore(path, self.FORMAT_VERSION)
+        self._entries = None
+
+    def lookup(self, u31):
+        """
+        Returns the cached entry matching the identity in u31's page 0 registers, or None.
+        """
+        return self._load().get(self._key(u31))
+
+    def store(self, u31, runtime_crc, u33_address):
+        entry = {
+            "runtime_crc": runtime_crc,
+            "u33_address": u33_address,
+            "max_report_len": u31.max_report_len,
+            "usages": [[u.id, u.start_page, u.num_pages, u.length, u.max_offset, u.offset_type, u.usage_rev]
+                       for u in u31.usage_table.values()],
+        }
+        entries = self._load()
+        entries[self._key(u31)] = entry
+        self._store.save(entries)
+
+    def clear(self):
+        self._entries = {}
+        self._store.remove()
+
+    def _key(self, u31):
+        return "%04X-%d.%d.%d-%d-%d-%d" % (u31.reg_device_id, u31.reg_fw_major, u31.reg_fw_minor, u31.reg_fw_patch,
+                                           u31.reg_fw_variant, u31.reg_fw_status, u31.reg_num_usages)
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._store.load()
+        return self._entries
@@ -3,12 +3,25 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
+import importlib
+from importlib.machinery import PathFinder
+
+# Transports are only imported when first used. A process normally talks over a single bus,
+# there is no need to pay for importing hid, smbus2 and spidev up front.
+_LAZY_ATTRIBUTES = {
+    "USB_Comms": ("USB_Comms", "USB_Comms"),
+    "byte2ascii": ("USB_Comms", "byte2ascii"),
+    "byte2int": ("USB_Comms", "byte2int"),
+    "I2C_Comms": ("I2C_Comms", "I2C_Comms"),
+    "SPI_Comms": ("SPI_Comms", "SPI_Comms"),
+    "u07_LiveView_Utils": ("u07_LiveView_Utils", None),
+}
+
 from .axiom import *
 from .CDU_Common import *
 from .u02_SystemManager import *
 from .u06_SelfTest import *
 from .u07_LiveView import *
-from . import u07_LiveView_Utils
 from .u31_DeviceInformation import *
 from .u32_DeviceCapabilities import *
 from .u33_CRCData import *
@@ -16,9 +29,12 @@ from .u48_GPIOControls import *
 
 __all__ = [
     "axiom",
+    "ConfigVerificationError",
     "Bootloader",
     "CDU_Common",
+    "CDU_Error",
     "u02_SystemManager",
+    "u02_CommandHandle",
     "u06_SelfTest",
     "u07_LiveView",
     "u07_LiveView_Utils",
@@ -26,33 +42,51 @@ __all__ = [
     "u32_DeviceCapabilities",
     "u33_CRCData",
     "u48_GPIOControls",
+    "UsageTableCache",
+    "CDUContentRecord",
+    "FirmwareImage",
+    "CommsCapabilities",
+    "FirmwareFlasher",
+    "FleetFlasher",
+    "FleetDeviceResult",
 ]
 
-from .axiom import axiom
+from .axiom import axiom, ConfigVerificationError
 from .Bootloader import Bootloader
-from .CDU_Common import CDU_Common
-from .u02_SystemManager import u02_SystemManager
+from .CDU_Common import CDU_Common, CDU_Error
+from .u02_SystemManager import u02_SystemManager, u02_CommandHandle
 from .u06_SelfTest import u06_SelfTest
 from .u07_LiveView import u07_LiveView
 from .u31_DeviceInformation import u31_DeviceInformation
 from .u32_DeviceCapabilities import u32_DeviceCapabilities
 from .u33_CRCData import u33_CRCData
 from .u48_GPIOControls import u48_GPIOControls
+from .UsageTableCache import UsageTableCache
+from .CDUContentRecord import CDUContentRecord
+from .FirmwareImage import FirmwareImage
+from .CommsCapabilities import CommsCapabilities
+from .FirmwareFlasher import FirmwareFlasher
+from .FleetFlasher import FleetFlasher, FleetDeviceResult
+from .Poller import Poller
+
+# Only advertise the transports whose interface package is installed
+for _transport, _interface_package in (("USB_Comms", "hid"), ("I2C_Comms", "smbus2"), ("SPI_Comms", "spidev")):
+    if PathFinder.find_spec(_interface_package) is not None:
+        __all__.append(_transport)
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module("." + module_name, __name__)
+    value = module if attribute is None else getattr(module, attribute)
+
+    # Cache the result so __getattr__ is only called on first use
+    globals()[name] = value
+    return value
+
 
-try:
-    from .USB_Comms import *
-    __all__.append("USB_Comms")
-except ImportError:
-    pass
-
-try:
-    from .I2C_Comms import *
-    __all__.append("I2C_Comms")
-except ImportError:
-    pass
-
-try:
-    from .SPI_Comms import *
-    __all__.append("SPI_Comms")
-except ImportError:
-    pass
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
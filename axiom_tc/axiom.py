@@ -3,12 +3,31 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
+import time
+
 from .CDU_Common import CDU_Common
+from .CDUContentRecord import CDUContentRecord
+from .CommsCapabilities import call_optional_comms_method
 from .u02_SystemManager import u02_SystemManager
 from .u31_DeviceInformation import u31_DeviceInformation
+from .u33_CRCData import u33_CRCData
+from .UsageTableCache import UsageTableCache
 from .Bootloader import Bootloader
 
 
+class ConfigVerificationError(Exception):
+    """
+    Raised when config written to aXiom does not verify. usage is the usage that failed, or None
+    when a batch failed CRC verification, in which case usages lists the usages in that batch.
+    """
+    def __init__(self, usage, message, expected=None, actual=None, usages=None):
+        super().__init__(message)
+        self.usage = usage
+        self.expected = expected
+        self.actual = actual
+        self.usages = usages if usages is not None else ([usage] if usage is not None else [])
+
+
 class axiom:
     TIMEOUT_MS = 5000  # timeout before giving up in comms
 
@@ -30,53 +49,204 @@ class axiom:
                       0x93,  # AE Profile
                       0x94]  # Delta scale map
 
-    def __init__(self, comms, read_usage_table=True):
+    # Verification performed by config_write_usage_to_device:
+    #   VERIFY_NONE     - trust the write
+    #   VERIFY_CRC      - defer to verify_config_crcs(), which compares u33 CRCs once per batch
+    #   VERIFY_READBACK - read the usage back and compare it with what was written
+    VERIFY_NONE = 0
+    VERIFY_CRC = 1
+    VERIFY_READBACK = 2
+
+    # CRCs reported by u33 for each CDU
+    CDU_CRC_REGISTERS = {0x22: "reg_u22_sequence_data_cdu_crc",
+                         0x43: "reg_u43_hotspots_cdu_crc",
+                         0x77: "reg_u77_dod_calibration_data_crc",
+                         0x93: "reg_u93_profiles_cdu_crc",
+                         0x94: "reg_u94_delta_scale_map_cdu_crc"}
+
+    # The firmware processes a usage write one page at a time, checking u02 for the
+    # config update to complete after each page. Set this to True for firmware that
+    # accepts a whole multi-page usage in a single transfer.
+    COALESCE_USAGE_WRITES = False
+
+    # Skip storing and committing a CDU whose u33 CRC shows it already holds the content being written
+    SKIP_UNCHANGED_CDUS = True
+
+    def __init__(self, comms, read_usage_table=True, usage_table_cache=None, shadow_writes=False,
+                 cdu_content_record=None):
+        connect_start = time.perf_counter()
         self._comms = comms
 
+        # Optional host side copy of each writable usage, as last read from or written to the
+        # device. When enabled, write_usage only sends the parts of a usage that have changed.
+        self.shadow_writes = shadow_writes
+        self._shadow = {}
+
+        # How config_write_usage_to_device verifies writes, see VERIFY_*
+        self.verify_mode = self.VERIFY_READBACK
+        self._crc_unverified_usages = set()
+
+        # CDU content written with VERIFY_CRC, recorded in cdu_content_record once its CRC verifies
+        self._crc_unverified_cdu_content = {}
+
+        # Optional persistent cache of the decoded usage table, either a path to the cache
+        # file or a UsageTableCache object that can be shared between axiom objects.
+        if isinstance(usage_table_cache, str):
+            usage_table_cache = UsageTableCache(usage_table_cache)
+        self.usage_table_cache = usage_table_cache
+
+        # Record of the u33 CRC each CDU content produced, either a path to the record file or a
+        # CDUContentRecord object. An in-memory record is created on the first CDU write if not given.
+        if isinstance(cdu_content_record, str):
+            cdu_content_record = CDUContentRecord(cdu_content_record)
+        self.cdu_content_record = cdu_content_record
+
+        # CDU CRCs from u33, read on demand and dropped whenever a CDU is committed
+        self._cdu_crcs = None
+
         # Pass the axiom object into comms for access to axiom data and methods
         comms.comms_init(self)
 
         # Objects to usages that are key to most axiom operations, however, most cannot be
-        # used if the device is in bootloader mode.
-        self.u31 = u31_DeviceInformation(self, read_usage_table)
+        # used if the device is in bootloader mode. u31 page 0 is read once, building the
+        # usage table reuses it and the bootloader flag comes from the decoded u31 registers.
+        self.u31 = u31_DeviceInformation(self, read_usage_table=read_usage_table)
 
-        if self.is_in_bootloader_mode():
-            self.u02 = None
-        else:
-            self.u02 = u02_SystemManager(self)
+        # u02 and the CDU helper are built on first use, see the u02 and cdu properties
+        self._u02 = None
+        self._cdu = None
+
+        # Time taken to connect to the device, including building the usage table
+        self.connect_time = time.perf_counter() - connect_start
 
     def read_usage(self, usage, length=None):
-        usage_content = []
+        # Reports do not occupy any pages, there is nothing to read
+        if self.u31.usage_table[usage].num_pages == 0:
+            return []
 
-        for pg in range(0, self.u31.usage_table[usage].num_pages):
-            # Calculate the remaining data to read for the last page
-            if pg == (self.u31.usage_table[usage].num_pages - 1):
-                read_length = self.u31.usage_table[usage].length - (self.u31.PAGE_SIZE * pg)
-            else:
-                read_length = self.u31.PAGE_SIZE
-
-            # If the user requests a specific amount of data, calculate how much data to read
-            # for this page.
-            if length is not None:
-                if length > self.u31.usage_table[usage].length:
-                    # Someone has requested more data than is available by the usage. Leave
-                    # read_length unmodified, this will effectively cap the read length to
-                    # the size of the usage.
-                    pass
-                elif (self.u31.PAGE_SIZE * (pg + 1)) > length:
-                    # Recalculate the read_length based on the length request.
-                    read_length = length - (self.u31.PAGE_SIZE * pg)
-
-            target_address = self.u31.convert_usage_to_target_address(usage, pg)
-            usage_content += self._comms.read_page(target_address, read_length)
-
-            if read_length < self.u31.PAGE_SIZE:
-                # Not a full page was required, therefore exit the loop early.
-                break
+        # A usage's pages are contiguous from its start page, so the whole usage can be
+        # read in as few transfers as the comms interface allows. If someone has requested
+        # more data than is available by the usage, cap the read length to the size of the usage.
+        read_length = self.u31.usage_table[usage].length
+        if (length is not None) and (length < read_length):
+            read_length = length
+
+        target_address = self.u31.convert_usage_to_target_address(usage, 0)
+        usage_content = self._read_contiguous(target_address, read_length)
+
+        if (read_length == self.u31.usage_table[usage].length) and self._is_shadowed(usage):
+            self._shadow[usage] = list(usage_content)
 
         return usage_content
 
+    def read_usage_range(self, usage, offset, length):
+        """
+        Reads length bytes starting offset bytes into a usage, e.g. a single register, without reading
+        the part of the usage before it. The range may cross page boundaries.
+        """
+        target_address = self._usage_range_to_target_address(usage, offset, length)
+        return self._read_contiguous(target_address, length)
+
+    def write_usage_range(self, usage, offset, data, check_progress=True):
+        """
+        Writes data starting offset bytes into a usage, leaving the rest of the usage untouched. The
+        range may cross page boundaries, each page written is followed by the usual u02 progress check
+        unless check_progress is False, e.g. for command interfaces that report their own status.
+        """
+        length = len(data)
+        target_address = self._usage_range_to_target_address(usage, offset, length)
+
+        call_optional_comms_method(self._comms, "begin_write_batch")
+        try:
+            if self.COALESCE_USAGE_WRITES:
+                self._write_contiguous(target_address, length, data)
+                if check_progress:
+                    self.u02.check_usage_write_progress(usage)
+            else:
+                # Split the write on page boundaries, as write_usage does
+                data_offset = 0
+                while data_offset < length:
+                    page_remaining = self.u31.PAGE_SIZE - ((offset + data_offset) % self.u31.PAGE_SIZE)
+                    write_length = min(length - data_offset, page_remaining)
+                    self._write_contiguous(target_address + data_offset, write_length,
+                                           data[data_offset:data_offset + write_length])
+                    if check_progress:
+                        self.u02.check_usage_write_progress(usage)
+                    data_offset += write_length
+        finally:
+            call_optional_comms_method(self._comms, "end_write_batch")
+
+        shadow = self._shadow.get(usage)
+        if shadow is not None:
+            shadow[offset:offset + length] = list(data)
+
+    def _usage_range_to_target_address(self, usage, offset, length):
+        usage_entry = self.u31.usage_table[usage]
+        if usage_entry.num_pages == 0:
+            raise ValueError("u%02X is a report and cannot be accessed by range" % usage)
+        if (offset < 0) or (length < 0) or ((offset + length) > usage_entry.length):
+            raise ValueError("u%02X: offset %d, length %d is outside the usage (length %d)" %
+                             (usage, offset, length, usage_entry.length))
+
+        # A usage's pages are contiguous, so the in-page offset carries straight into the following pages
+        return self.u31.convert_usage_to_target_address(usage, 0) + offset
+
     def write_usage(self, usage, buffer):
+        # Comms interfaces that defer write acknowledgements collect them at the end of the usage
+        call_optional_comms_method(self._comms, "begin_write_batch")
+        try:
+            self._write_usage_pages(usage, buffer)
+        finally:
+            call_optional_comms_method(self._comms, "end_write_batch")
+
+    def _write_usage_pages(self, usage, buffer):
+        usage_length = self.get_usage_length(usage)
+
+        if self._is_shadowed(usage):
+            shadow = self._shadow.get(usage)
+            if (shadow is not None) and (len(buffer) >= usage_length):
+                self._write_usage_changes(usage, buffer, shadow)
+            else:
+                self._write_usage_all_pages(usage, buffer)
+            self._shadow[usage] = list(buffer[0:usage_length])
+        else:
+            self._write_usage_all_pages(usage, buffer)
+
+    def _write_usage_changes(self, usage, buffer, shadow):
+        usage_length = self.get_usage_length(usage)
+        target_address = self.u31.convert_usage_to_target_address(usage, 0)
+
+        for page_start in range(0, usage_length, self.u31.PAGE_SIZE):
+            page_end = min(page_start + self.u31.PAGE_SIZE, usage_length)
+            if list(buffer[page_start:page_end]) == shadow[page_start:page_end]:
+                continue  # Page is unchanged, nothing to send
+
+            # Find the changed byte range within this page
+            first = page_start
+            while buffer[first] == shadow[first]:
+                first += 1
+            last = page_end - 1
+            while buffer[last] == shadow[last]:
+                last -= 1
+
+            # Registers are 16 bits wide, keep the write aligned to whole registers
+            first &= ~1
+            end = min(last + 1 + ((last + 1) & 1), page_end)
+
+            self._write_contiguous(target_address + first, end - first, buffer[first:end])
+            self.u02.check_usage_write_progress(usage)
+
+    def _write_usage_all_pages(self, usage, buffer):
+        usage_length = self.get_usage_length(usage)
+        target_address = self.u31.convert_usage_to_target_address(usage, 0)
+
+        if self.COALESCE_USAGE_WRITES:
+            # The firmware is trusted to handle a multi-page write, the whole usage is
+            # written in as few transfers as the comms interface allows.
+            self._write_contiguous(target_address, usage_length, buffer)
+            self.u02.check_usage_write_progress(usage)
+            return
+
         buffer_offset = 0
 
         for pg in range(0, self.u31.usage_table[usage].num_pages):
@@ -84,16 +254,138 @@ class axiom:
 
             # Calculate the remaining data to read for the last page
             if pg == (self.u31.usage_table[usage].num_pages - 1):
-                write_length = self.get_usage_length(usage) - (self.u31.PAGE_SIZE * pg)
+                write_length = usage_length - (self.u31.PAGE_SIZE * pg)
 
             buffer_offset_end = buffer_offset + write_length
-            target_address = self.u31.convert_usage_to_target_address(usage, pg)
 
-            self._comms.write_page(target_address, write_length, buffer[buffer_offset:buffer_offset_end])
+            self._write_contiguous(target_address + buffer_offset, write_length,
+                                   buffer[buffer_offset:buffer_offset_end])
             self.u02.check_usage_write_progress(usage)
 
             buffer_offset += self.u31.PAGE_SIZE
 
+    def read_many(self, requests):
+        """
+        Reads several register ranges, possibly spread across different usages, in one go. Ranges that
+        are adjacent or overlap in aXiom's address space are merged and read together, split only on
+        the comms interface's transfer limit.
+
+        Parameters:
+        requests: A sequence of (usage, offset, length) tuples, offset being the byte offset into the usage.
+
+        Returns:
+        list: A memoryview of the bytes read for each request, in the order of the requests.
+        """
+        spans, placements = self._plan_read_spans(requests)
+
+        span_buffers = []
+        for target_address, length in spans:
+            span_buffer = bytearray(length)
+            self._read_contiguous_into(target_address, length, span_buffer)
+            span_buffers.append(span_buffer)
+
+        return [memoryview(span_buffers[span])[offset:offset + length] for span, offset, length in placements]
+
+    def plan_read_many(self, requests):
+        """
+        Returns the transport reads read_many() would issue for the same requests, as a list of
+        (target_address, length) tuples. The length of the list is the number of transactions.
+        """
+        spans, _ = self._plan_read_spans(requests)
+        max_length = self._max_read_length()
+
+        transactions = []
+        for target_address, length in spans:
+            for offset in range(0, length, max_length):
+                transactions.append((target_address + offset, min(length - offset, max_length)))
+        return transactions
+
+    def _plan_read_spans(self, requests):
+        # Map each request onto aXiom's address space, then merge the ranges that touch into spans
+        ranges = []
+        for index, (usage, offset, length) in enumerate(requests):
+            ranges.append((self._usage_range_to_target_address(usage, offset, length), length, index))
+
+        spans = []
+        placements = [None] * len(ranges)
+        for target_address, length, index in sorted(ranges):
+            if spans and (target_address <= (spans[-1][0] + spans[-1][1])):
+                span_address, span_length = spans[-1]
+                spans[-1] = (span_address, max(span_length, target_address + length - span_address))
+            else:
+                spans.append((target_address, length))
+            placements[index] = (len(spans) - 1, target_address - spans[-1][0], length)
+
+        return spans, placements
+
+    def _read_contiguous_into(self, target_address, length, out):
+        # Comms interfaces that can read straight into a buffer avoid building a list per transfer
+        max_length = self._max_read_length()
+        read_page_into = getattr(self._comms, "read_page_into", None)
+        out_view = memoryview(out)
+        offset = 0
+
+        while offset < length:
+            read_length = min(length - offset, max_length)
+            if read_page_into is not None:
+                read_page_into(target_address + offset, read_length, out_view[offset:offset + read_length])
+            else:
+                out_view[offset:offset + read_length] = bytes(self._comms.read_page(target_address + offset,
+                                                                                    read_length))
+            offset += read_length
+
+    def _max_read_length(self):
+        # Comms objects that do not advertise a limit are read a page at a time
+        capabilities = getattr(self._comms, "capabilities", None)
+        if capabilities is not None:
+            return capabilities.max_read_payload
+        return getattr(self._comms, "MAX_READ_LENGTH", self.u31.PAGE_SIZE)
+
+    def _max_write_length(self):
+        capabilities = getattr(self._comms, "capabilities", None)
+        if capabilities is not None:
+            return capabilities.max_write_payload
+        return getattr(self._comms, "MAX_WRITE_LENGTH", self.u31.PAGE_SIZE)
+
+    def _read_contiguous(self, target_address, length):
+        # Split the read on the comms interface's transfer limit rather than on page boundaries
+        max_length = self._max_read_length()
+        content = []
+        offset = 0
+
+        while offset < length:
+            read_length = min(length - offset, max_length)
+            content += self._comms.read_page(target_address + offset, read_length)
+            offset += read_length
+
+        return content
+
+    def _write_contiguous(self, target_address, length, buffer):
+        max_length = self._max_write_length()
+        offset = 0
+
+        while offset < length:
+            write_length = min(length - offset, max_length)
+            self._comms.write_page(target_address + offset, write_length, buffer[offset:offset + write_length])
+            offset += write_length
+
+    def _is_shadowed(self, usage):
+        # u02 and CDUs are command interfaces rather than config, their contents are changed
+        # by the device itself. Read only usages and reports are never written.
+        return (self.shadow_writes and
+                (usage != u02_SystemManager.USAGE_ID) and
+                (usage not in self.cdu_usage_list) and
+                (usage not in self.ignore_usage_list) and
+                (self.u31.usage_table[usage].num_pages != 0))
+
+    def invalidate_caches(self):
+        # The device's config no longer matches what the host last saw, e.g. after a reset,
+        # filling the config or entering the bootloader.
+        self._shadow = {}
+        self._cdu_crcs = None
+        if self._cdu is not None:
+            self._cdu.invalidate_geometry()
+
     def get_usage_revision(self, usage):
         if not self.u31.usage_table_populated:
             revision = 0
@@ -108,29 +400,153 @@ class axiom:
             return 0
 
     def is_in_bootloader_mode(self):
-        u31_ta = 0x0000
-        u31_page0 = self._comms.read_page(u31_ta, 12)
-        return True if (u31_page0[1] & 0x80) else False
+        # Refresh u31 page 0 so the decoded registers reflect the device's current mode
+        self.u31.read()
+        return self.u31.reg_mode != 0
+
+    @property
+    def u02(self):
+        # u02 cannot be used in bootloader mode or before the usage table is known, it is
+        # None until both are satisfied.
+        if (self._u02 is None) and self.u31.usage_table_populated and (self.u31.reg_mode == 0):
+            self._u02 = u02_SystemManager(self)
+        return self._u02
+
+    @u02.setter
+    def u02(self, u02):
+        self._u02 = u02
+
+    @property
+    def cdu(self):
+        # One CDU helper per device, so its statistics persist across CDU operations
+        if self._cdu is None:
+            self._cdu = CDU_Common(self)
+        return self._cdu
+
+    def config_write_usage_to_device(self, usage, buffer, verify=None):
+        # Returns the usage's content as best known after the write: the read back content when
+        # it was verified that way, otherwise the content that was written. Read only usages
+        # are skipped and return None.
+        if verify is None:
+            verify = self.verify_mode
 
-    def config_write_usage_to_device(self, usage, buffer):
         if usage in self.ignore_usage_list:  # These are informational usages or read only
-            pass
-        elif usage in self.cdu_usage_list:  # Command driven usages need to be handled separately
-            cdu = CDU_Common(self)
-            cdu.write(usage, buffer)
-            cdu_content = cdu.read(usage)
-
-            if buffer != cdu_content:
-                print("ERROR: Failed to write CDU contents. u%02X" % usage)
+            return None
+
+        if usage in self.cdu_usage_list:  # Command driven usages need to be handled separately
+            if self._is_cdu_unchanged(usage, buffer):
+                # The device's CRC already matches this content, there is nothing to write or verify
+                return list(buffer)
+            self.cdu.write(usage, buffer)
         else:
             self.write_usage(usage, buffer)
-            usage_buffer = self.read_usage(usage)
 
-            if buffer != usage_buffer:
-                print("ERROR: Failed to write config to usage 0x%x" % usage)
-                print("Expected Length: %d and Actual Length: %d" % (len(buffer), len(usage_buffer)))
-                print("Expecting: " + str(buffer))
-                print("Read from Device: " + str(usage_buffer))
+        device_content = list(buffer)
+        if verify == self.VERIFY_READBACK:
+            if usage in self.cdu_usage_list:
+                device_content = self.cdu.read(usage)
+            else:
+                device_content = self.read_usage(usage)
+
+            if list(buffer) != device_content:
+                raise ConfigVerificationError(usage, "Failed to write config to usage u%02X" % usage,
+                                              expected=list(buffer), actual=device_content)
+            if self._is_cdu_recordable(usage):
+                self._record_cdu_content(usage, buffer, self._read_cdu_crc(usage))
+        elif verify == self.VERIFY_CRC:
+            # Checked in one go by verify_config_crcs() at the end of the batch
+            self._crc_unverified_usages.add(usage)
+            if self._is_cdu_recordable(usage):
+                self._crc_unverified_cdu_content[usage] = list(buffer)
+
+        # Unverified CDU writes are never recorded, the device may not hold the content
+        return device_content
+
+    def _is_cdu_recordable(self, usage):
+        # Only CDUs with a CRC in u33 can be recorded, checked first so the CRCs are not read for nothing
+        return self.SKIP_UNCHANGED_CDUS and (usage in self.CDU_CRC_REGISTERS)
+
+    def _is_cdu_unchanged(self, usage, buffer):
+        if (not self._is_cdu_recordable(usage)) or (self.cdu_content_record is None):
+            return False
+
+        recorded_crc = self.cdu_content_record.lookup(self.u31.reg_device_id, usage, buffer)
+        return (recorded_crc is not None) and (recorded_crc == self._read_cdu_crc(usage))
+
+    def _record_cdu_content(self, usage, buffer, crc):
+        # Remember the CRC verified content produced, so writing it again can be skipped
+        if (not self.SKIP_UNCHANGED_CDUS) or (crc is None):
+            return
+
+        if self.cdu_content_record is None:
+            self.cdu_content_record = CDUContentRecord()
+
+        self.cdu_content_record.store(self.u31.reg_device_id, usage, buffer, crc)
+
+    def invalidate_cdu_crcs(self):
+        # Called by CDU_Common whenever a CDU is committed, the device's CDU CRCs have changed
+        self._cdu_crcs = None
+
+    def _read_cdu_crc(self, usage):
+        # The device recomputes its CRCs once, then they are reused until a CDU is committed
+        if self._cdu_crcs is None:
+            self.u02.send_command(self.u02.CMD_COMPUTE_CRCS)
+            device_u33 = u33_CRCData(self)
+            self._cdu_crcs = {cdu: getattr(device_u33, register)
+                              for cdu, register in self.CDU_CRC_REGISTERS.items()
+                              if hasattr(device_u33, register)}
+        return self._cdu_crcs.get(usage)
+
+    def verify_config_crcs(self, expected_u33):
+        """
+        Verifies the config written with VERIFY_CRC against the CRCs expected for it, typically the u33
+        content saved alongside the config. The device is asked to recompute its CRCs and the RAM usage
+        config CRC and the CRC of every CDU present are compared.
+
+        Parameters:
+        expected_u33: A u33_CRCData object, or the raw u33 usage content, holding the expected CRCs.
+
+        Raises:
+        ConfigVerificationError: If any of the CRCs do not match.
+        """
+        if not isinstance(expected_u33, u33_CRCData):
+            expected_u33_content = list(expected_u33)
+            expected_u33 = u33_CRCData(self, read=False)
+            expected_u33._usage_binary_data = expected_u33_content
+            expected_u33._unpack()
+
+        self.u02.send_command(self.u02.CMD_COMPUTE_CRCS)
+        device_u33 = u33_CRCData(self)
+
+        crc_registers = [(None, "RAM Usage Config", "reg_vltl_usage_config_crc")]
+        for usage, register in self.CDU_CRC_REGISTERS.items():
+            if self.u31.is_usage_present_on_device(usage):
+                crc_registers.append((usage, "u%02X" % usage, register))
+
+        mismatches = []
+        verified_cdus = {}
+        for usage, name, register in crc_registers:
+            if not (hasattr(device_u33, register) and hasattr(expected_u33, register)):
+                continue  # The CRC is not reported by one of the u33 revisions
+            device_crc = getattr(device_u33, register)
+            expected_crc = getattr(expected_u33, register)
+            if device_crc != expected_crc:
+                mismatches.append("%s CRC 0x%08X, expected 0x%08X" % (name, device_crc, expected_crc))
+            elif usage is not None:
+                verified_cdus[usage] = device_crc
+
+        # Only CDU content whose CRC has just been verified is recorded
+        for usage, content in self._crc_unverified_cdu_content.items():
+            if usage in verified_cdus:
+                self._record_cdu_content(usage, content, verified_cdus[usage])
+        self._crc_unverified_cdu_content = {}
+
+        unverified_usages = sorted(self._crc_unverified_usages)
+        self._crc_unverified_usages = set()
+
+        if mismatches:
+            raise ConfigVerificationError(None, "Config CRC mismatch: " + ", ".join(mismatches),
+                                          usages=unverified_usages)
 
     def close(self):
         self._comms.close()
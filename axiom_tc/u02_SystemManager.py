@@ -4,8 +4,56 @@
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
 import struct
+import time
 from time import sleep
 
+from .Poller import Poller
+
+
+class u02_CommandHandle:
+    """
+    Tracks a system manager command issued by u02_SystemManager.send_command_async(). The command
+    runs on the device while the host is free to do other work, poll() checks on it once without
+    blocking.
+    """
+    def __init__(self, u02, command, device_id, timeout):
+        self.command = command
+        self.result = None
+        self.duration = None
+        self._u02 = u02
+        self._device_id = device_id
+        self._start = time.perf_counter()
+        self._deadline = self._start + timeout
+
+    @property
+    def done(self):
+        return self.result is not None
+
+    def poll(self):
+        """
+        Polls the device once. Returns True once the command has completed, its result is then in result:
+        0 on success, otherwise the u02 error code or the command value if it timed out.
+        """
+        if self.done:
+            return True
+
+        result = self._u02._poll_command(self.command, self._device_id)
+        now = time.perf_counter()
+        if (result is None) and (now >= self._deadline):
+            print("ERROR: u02 System Manager command %d did not complete within %.1fs" %
+                  (self.command, self._deadline - self._start))
+            result = self.command
+
+        if result is not None:
+            self.result = result
+            self.duration = now - self._start
+        return self.done
+
+    def wait(self):
+        # Blocks until the command completes, returns its result
+        u02_SystemManager.wait_all([self])
+        return self.result
+
 
 class u02_SystemManager:
     USAGE_ID = 0x02
@@ -21,9 +69,35 @@ class u02_SystemManager:
     CMD_ENTER_BOOTLOADER = 11
     CMD_RUN_SELF_TESTS = 12
 
+    # Budget, in seconds, for each command to complete. Polling starts as soon as the command
+    # is written, so these only bound how long a command that never completes is waited for.
+    DEFAULT_COMMAND_TIMEOUT = 1.1
+    COMMAND_TIMEOUTS = {
+        CMD_HARD_RESET: 2.0,
+        CMD_SOFT_RESET: 2.0,
+        CMD_SAVE_CONFIG: 2.0,
+        CMD_FILL_CONFIG: 2.0,
+        CMD_ENTER_BOOTLOADER: 1.0,
+    }
+
+    # Budget for the firmware to process a config update after a usage write
+    WRITE_PROGRESS_TIMEOUT = 1.0
+
     def __init__(self, axiom):
         self._axiom = axiom
 
+        # Polls the command word after usage writes. Its poll counts and wait times can be
+        # inspected, and its backoff tuned, for each bus.
+        self.write_progress_poller = Poller(self.WRITE_PROGRESS_TIMEOUT)
+
+        # Polls for system manager commands to complete, backing off up to 20ms between polls
+        self.command_poller = Poller(self.DEFAULT_COMMAND_TIMEOUT, initial_delay=0.001, max_delay=0.02)
+
+        # While deferred, progress checks are collected and performed once by
+        # end_deferred_write_progress()
+        self._deferred_write_progress = 0
+        self._deferred_write_progress_usages = []
+
         # Get the usage number from the axiom class
         self._usage_revision = self._axiom.get_usage_revision(self.USAGE_ID)
 
@@ -71,20 +145,56 @@ class u02_SystemManager:
 
     # region u02 Specific Methods
     def send_command(self, command):
-        skip_verify = False
+        device_id = self._issue_command(command)
+        return self._wait_for_command(command, device_id)
+
+    def send_command_async(self, command):
+        """
+        Issues a command without waiting for it to complete. Commands on several devices can then be
+        in flight at the same time, see wait_all().
+
+        Returns:
+        u02_CommandHandle: Handle used to poll for, or wait on, the command's completion.
+        """
+        device_id = self._issue_command(command)
+        timeout = self.COMMAND_TIMEOUTS.get(command, self.DEFAULT_COMMAND_TIMEOUT)
+        return u02_CommandHandle(self, command, device_id, timeout)
+
+    @staticmethod
+    def wait_all(handles, poll_interval=0.001):
+        """
+        Waits for all the given command handles to complete, typically commands on different devices.
+        The handles are polled round-robin, sleeping poll_interval between rounds where nothing completed.
+
+        Returns:
+        list: The result of each command, in the order of the handles.
+        """
+        pending = [handle for handle in handles if not handle.done]
+        while pending:
+            still_pending = [handle for handle in pending if not handle.poll()]
+            if len(still_pending) == len(pending):
+                sleep(poll_interval)
+            pending = still_pending
+        return [handle.result for handle in handles]
+
+    def _issue_command(self, command):
+        # Returns the device ID before the command, used to recognise the device coming back from a reset
+        device_id = self._axiom.u31.reg_device_id
         self.reg_command = command
 
+        # These commands change the device's config behind the host's back
+        if command in (self.CMD_HARD_RESET, self.CMD_SOFT_RESET, self.CMD_FILL_CONFIG, self.CMD_ENTER_BOOTLOADER):
+            self._axiom.invalidate_caches()
+
         if command == self.CMD_SAVE_CONFIG:
             self.reg_parameters[0] = 0x0000
             self.reg_parameters[1] = 0xB10C
             self.reg_parameters[2] = 0xC0DE
             self.write()
-            sleep(0.1)
         elif command == self.CMD_ENTER_BOOTLOADER:
             # To enter the bootloader, a sequence of writes are
             # required to ensure it is intentional to go into
             # the bootloader.
-            skip_verify = True
             self.reg_command = command
             self.reg_parameters[0] = 0x5555
             self.write()
@@ -95,8 +205,7 @@ class u02_SystemManager:
             sleep(0.001)
             self.reg_command = command
             self.reg_parameters[0] = 0xA55A
-            self.write()
-            sleep(0.2)
+            self._write_resetting_command()
         elif command == self.CMD_FILL_CONFIG:
             # Fill the config area with zeros
             self.reg_command = command
@@ -104,38 +213,75 @@ class u02_SystemManager:
             self.reg_parameters[1] = 0xAAAA
             self.reg_parameters[2] = 0xA55A
             self.write()
-            sleep(0.1)
+        elif command in (self.CMD_HARD_RESET, self.CMD_SOFT_RESET):
+            self._write_resetting_command()
         else:
-            # Don't perform u02 verify reads for reset commands
-            if (command == self.CMD_HARD_RESET or
-                    command == self.CMD_SOFT_RESET):
-                skip_verify = True
+            self.write()
 
+        return device_id
+
+    def _write_resetting_command(self):
+        # aXiom resets as soon as it accepts the command, the write may not be acknowledged.
+        # Whether the command took effect is confirmed by polling for the reset/bootloader.
+        try:
             self.write()
-            sleep(0.1)
-
-        # Check the status of the command for up to 1 second (10ms sleeps)
-        if not skip_verify:
-            for _ in range(100):
-                # Update the registers
-                self.read()
-
-                # Check the command value, if it is 0, then the command has
-                # completed successfully. If the command register still has
-                # the same value as the written command value, then the command
-                # is still in progress. Any other response would indicate an error.
-                if self.reg_command == command:
-                    # Command is still in progress
-                    sleep(0.01)
-                    continue
-                elif self.reg_command == 0x0000:
-                    # Command completed successfully
-                    return 0
-                else:
-                    # Command failed
-                    print("ERROR: u02 System Manager command failed with error code: %04X" % self.reg_command)
-                    return self.reg_command
-        return 0
+        except IOError:
+            pass
+
+    def _wait_for_command(self, command, device_id):
+        # Polling starts straight away, most commands complete well within the budget
+        timeout = self.COMMAND_TIMEOUTS.get(command, self.DEFAULT_COMMAND_TIMEOUT)
+        try:
+            return self.command_poller.poll(lambda: self._poll_command(command, device_id), timeout)
+        except TimeoutError:
+            print("ERROR: u02 System Manager command %d did not complete within %.1fs" % (command, timeout))
+            return command
+
+    def _poll_command(self, command, device_id):
+        # Polls the device once. Returns None while the command is in progress, otherwise the
+        # command's result: 0 on success or the error code reported by u02.
+        if command in (self.CMD_HARD_RESET, self.CMD_SOFT_RESET):
+            return self._poll_reset(device_id)
+        elif command == self.CMD_ENTER_BOOTLOADER:
+            return self._poll_bootloader_entry()
+
+        # Update the registers, u02 is only 8 bytes so the parameters come for free with the command
+        self.read()
+
+        # Check the command value, if it is 0, then the command has
+        # completed successfully. If the command register still has
+        # the same value as the written command value, then the command
+        # is still in progress. Any other response would indicate an error.
+        if self.reg_command == command:
+            # Command is still in progress
+            return None
+        elif self.reg_command == 0x0000:
+            # Command completed successfully
+            return 0
+        else:
+            # Command failed
+            print("ERROR: u02 System Manager command failed with error code: %04X" % self.reg_command)
+            return self.reg_command
+
+    def _poll_reset(self, device_id):
+        # While aXiom resets it may not respond on the bus at all, or respond with nothing but
+        # zeros. The reset has completed once u31 page 0 reads back the same device running
+        # firmware again and the reset command is no longer showing in u02.
+        try:
+            self._axiom.u31.read()
+            if (self._axiom.u31.reg_device_id != device_id) or (self._axiom.u31.reg_mode != 0):
+                return None
+            return 0 if self._read_command_word() == 0x0000 else None
+        except (AssertionError, IOError):
+            return None
+
+    def _poll_bootloader_entry(self):
+        # Entering the bootloader is complete once u31 page 0 reports bootloader mode
+        try:
+            self._axiom.u31.read()
+        except (AssertionError, IOError):
+            return None
+        return 0 if self._axiom.u31.reg_mode != 0 else None
 
     def check_usage_write_progress(self, usage):
         # After a usage write, the firmware will notify the relevant usages of a
@@ -148,25 +294,40 @@ class u02_SystemManager:
         if (usage == self.USAGE_ID) or (usage in self._axiom.cdu_usage_list):
             return
 
-        # Retry 1000 times over 1s.
-        for _ in range(1000):
-            self.read()
-
-            if self.reg_command == 0x0000:
-                # Response value of zero indicates that u02 is not currently
-                # busy. We can safely return now.
-                return
-
-            # A response of 0x7FFF indicates that u02 is reporting that it is
-            # still processing the last read. However, as a catch-all, attempt
-            # a retry until all retries expire.
-            sleep(0.001)  # sleep 1ms, give the device some time to complete
-
-        # Should not get here - this error should be handled. Seeing this error
-        # message indicates that a usage was written, aXiom then processes the
-        # update and aXiom was still reporting that it was busy after 1 second
-        # (10 retries with 100ms delays).
-        print("ERROR: u02 In progress. u%02X - %04X" % (usage, self.reg_command))
+        if self._deferred_write_progress > 0:
+            self._deferred_write_progress_usages.append(usage)
+            return
+
+        self._wait_for_write_progress("u%02X" % usage)
+
+    def begin_deferred_write_progress(self):
+        # Defer usage write progress checks, e.g. across a multi-usage config load. The checks
+        # are performed once, when the outermost end_deferred_write_progress() is called.
+        self._deferred_write_progress += 1
+
+    def end_deferred_write_progress(self):
+        self._deferred_write_progress -= 1
+        if (self._deferred_write_progress == 0) and self._deferred_write_progress_usages:
+            usages = ", ".join("u%02X" % usage for usage in sorted(set(self._deferred_write_progress_usages)))
+            self._deferred_write_progress_usages = []
+            self._wait_for_write_progress(usages)
+
+    def _wait_for_write_progress(self, usages):
+        # Only the command word is polled. A response value of zero indicates that u02 is not
+        # currently busy. A response of 0x7FFF indicates that u02 is still processing the last
+        # write, however, as a catch-all, any non-zero value is retried until the timeout.
+        try:
+            self.write_progress_poller.poll(lambda: 0 if self._read_command_word() == 0x0000 else None)
+        except TimeoutError:
+            # Should not get here - this error should be handled. Seeing this error
+            # message indicates that a usage was written, aXiom then processes the
+            # update and aXiom was still reporting that it was busy after the timeout.
+            print("ERROR: u02 In progress. %s - %04X" % (usages, self.reg_command))
+
+    def _read_command_word(self):
+        command = self._axiom.read_usage_range(self.USAGE_ID, 0, 2)
+        self.reg_command = command[0] | (command[1] << 8)
+        return self.reg_command
 
     # endregion
 
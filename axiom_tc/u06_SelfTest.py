@@ -3,33 +3,37 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
+import importlib
 from time import sleep
 
-from .u06_SelfTest_rev3 import u06_SelfTestRev3
-from .u06_SelfTest_rev4 import u06_SelfTestRev4
-from .u06_SelfTest_rev5 import u06_SelfTestRev5
-from .u06_SelfTest_rev6 import u06_SelfTestRev6
-from .u06_SelfTest_rev7 import u06_SelfTestRev7
-
 
 class u06_SelfTest:
     USAGE_ID = 0x06
     _REVISION_MAP = {
-        3: u06_SelfTestRev3,
-        4: u06_SelfTestRev4,
-        5: u06_SelfTestRev5,
-        6: u06_SelfTestRev6,
-        7: u06_SelfTestRev7,
+        3: ("u06_SelfTest_rev3", "u06_SelfTestRev3"),
+        4: ("u06_SelfTest_rev4", "u06_SelfTestRev4"),
+        5: ("u06_SelfTest_rev5", "u06_SelfTestRev5"),
+        6: ("u06_SelfTest_rev6", "u06_SelfTestRev6"),
+        7: ("u06_SelfTest_rev7", "u06_SelfTestRev7"),
     }
 
     def __init__(self, axiom, read=True):
         self._axiom = axiom
         self._usage_revision = self._axiom.get_usage_revision(self.USAGE_ID)
-        usage_handler = self._REVISION_MAP.get(self._usage_revision)
+        usage_handler = self._load_revision_handler(self._usage_revision)
         if usage_handler is None:
             raise Exception(f"Unsupported revision of u06 SelfTest: {self._usage_revision}")
         self._usage_handler = usage_handler(axiom, self.USAGE_ID, read)
 
+    @classmethod
+    def _load_revision_handler(cls, usage_revision):
+        # Only the module for the device's usage revision is imported
+        revision = cls._REVISION_MAP.get(usage_revision)
+        if revision is None:
+            return None
+        module_name, class_name = revision
+        return getattr(importlib.import_module("." + module_name, __package__), class_name)
+
     def read(self):
         self._usage_handler.read()
 
@@ -3,38 +3,40 @@
 # This file is part of axiom_tc and is released under the MIT License:
 # See the LICENSE file in the root directory of this project or http://opensource.org/licenses/MIT.
 
-from .u07_LiveView_rev6  import u07_LiveViewRev6
-from .u07_LiveView_rev7  import u07_LiveViewRev7
-from .u07_LiveView_rev8  import u07_LiveViewRev8
-from .u07_LiveView_rev9  import u07_LiveViewRev9
-from .u07_LiveView_rev10 import u07_LiveViewRev10
-from .u07_LiveView_rev11 import u07_LiveViewRev11
-from .u07_LiveView_rev12 import u07_LiveViewRev12
-from .u07_LiveView_rev13 import u07_LiveViewRev13
-from .u07_LiveView_rev14 import u07_LiveViewRev14
+import importlib
+
 
 class u07_LiveView:
     USAGE_ID = 0x07
     _REVISION_MAP = {
-        6:  u07_LiveViewRev6,
-        7:  u07_LiveViewRev7,
-        8:  u07_LiveViewRev8,
-        9:  u07_LiveViewRev9,
-        10: u07_LiveViewRev10,
-        11: u07_LiveViewRev11,
-        12: u07_LiveViewRev12,
-        13: u07_LiveViewRev13,
-        14: u07_LiveViewRev14,
+        6:  ("u07_LiveView_rev6", "u07_LiveViewRev6"),
+        7:  ("u07_LiveView_rev7", "u07_LiveViewRev7"),
+        8:  ("u07_LiveView_rev8", "u07_LiveViewRev8"),
+        9:  ("u07_LiveView_rev9", "u07_LiveViewRev9"),
+        10: ("u07_LiveView_rev10", "u07_LiveViewRev10"),
+        11: ("u07_LiveView_rev11", "u07_LiveViewRev11"),
+        12: ("u07_LiveView_rev12", "u07_LiveViewRev12"),
+        13: ("u07_LiveView_rev13", "u07_LiveViewRev13"),
+        14: ("u07_LiveView_rev14", "u07_LiveViewRev14"),
     }
 
     def __init__(self, axiom, read=True):
         self._axiom = axiom
         self._usage_revision = self._axiom.get_usage_revision(self.USAGE_ID)
-        usage_handler = self._REVISION_MAP.get(self._usage_revision)
+        usage_handler = self._load_revision_handler(self._usage_revision)
         if usage_handler is None:
             raise Exception(f"Unsupported revision of u07 Live View: {self._usage_revision}")
         self._usage_handler = usage_handler(axiom, self.USAGE_ID, read)
 
+    @classmethod
+    def _load_revision_handler(cls, usage_revision):
+        # Only the module for the device's usage revision is imported
+        revision = cls._REVISION_MAP.get(usage_revision)
+        if revision is None:
+            return None
+        module_name, class_name = revision
+        return getattr(importlib.import_module("." + module_name, __package__), class_name)
+
     def read(self):
         self._usage_handler.read()
 
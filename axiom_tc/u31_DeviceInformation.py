@@ -67,13 +67,14 @@ class u31_DeviceInformation:
         self.max_report_len = 0
         self._usage_table = {}
         self._usage_table_populated = False
+        self.usage_table_from_cache = False
 
-        # Populate the registers by reading the device
-        if read:
-            self.read()
-
+        # Populate the registers by reading the device. Building the usage table reads
+        # page 0 itself, so it is only read separately when the table is not wanted.
         if read_usage_table:
             self.build_usage_table()
+        elif read:
+            self.read()
 
     def read(self):
         self._usage_binary_data = self._axiom._comms.read_page(self.u31_TARGET_ADDRESS, self.u31_PAGE_0_LEN)
@@ -115,12 +116,18 @@ class u31_DeviceInformation:
         self.max_report_len = 0
         self._usage_table = {}
         self._usage_table_populated = False
+        self.usage_table_from_cache = False
         self.read()
 
         # Verify the device is not in bootloader mode
         if self.reg_mode != 0:
             return False
 
+        # A cached table is only trusted if the device is still running the same firmware
+        cache = self._axiom.usage_table_cache
+        if (cache is not None) and self._load_usage_table_from_cache(cache):
+            return True
+
         target_address = self.convert_usage_to_target_address(0x31, 1)
         usage_buffer = self._axiom._comms.read_page(target_address,
                                                     (self.reg_num_usages * _Usage_Table_Entry.USAGE_TABLE_ENTRY_SIZE))
@@ -151,8 +158,41 @@ class u31_DeviceInformation:
                 self.max_report_len = length
 
         self._usage_table_populated = True
+
+        if cache is not None:
+            self._store_usage_table_in_cache(cache)
+
+        return True
+
+    def _read_runtime_crc(self, u33_address):
+        # The runtime CRC is the first register of u33 in every revision
+        crc = self._axiom._comms.read_page(u33_address, 4)
+        return crc[0] | (crc[1] << 8) | (crc[2] << 16) | (crc[3] << 24)
+
+    def _load_usage_table_from_cache(self, cache):
+        entry = cache.lookup(self)
+        if entry is None:
+            return False
+
+        if self._read_runtime_crc(entry["u33_address"]) != entry["runtime_crc"]:
+            return False
+
+        for id, start_page, num_pages, length, max_offset, offset_type, usage_rev in entry["usages"]:
+            self._usage_table[id] = _Usage_Table_Entry(id, start_page, num_pages, length, max_offset, offset_type,
+                                                       usage_rev)
+        self.max_report_len = entry["max_report_len"]
+        self._usage_table_populated = True
+        self.usage_table_from_cache = True
         return True
 
+    def _store_usage_table_in_cache(self, cache):
+        # Without u33 there is no runtime CRC to validate the entry against, so don't cache it
+        if not self.is_usage_present_on_device(0x33):
+            return
+
+        u33_address = self.convert_usage_to_target_address(0x33)
+        cache.store(self, self._read_runtime_crc(u33_address), u33_address)
+
     def print_usage_table(self):
         if self._usage_table_populated:
             print("Usage Table: ")